@@ -4,15 +4,22 @@ from datetime import datetime
 from math import ceil
 
 from celery.result import AsyncResult
-from flask import Blueprint, request, jsonify, current_app, g
+from flask import Blueprint, request, jsonify, g
 
 from connection import db
 from core.auth.authenticator import login_required, get_current_user
-from core.interface.ops_interface import start_embedding_task, doc_search
+from core.interface.ops_interface import (
+    start_embedding_task,
+    doc_search,
+    invalidate_vector_store,
+)
+from core.task_progress import EMBEDDING_TASK_PREFIX, TaskRedisRecords
 from model.file import DbFile, DbEmbedding, TaskStatus
 from model.types import ApiType
 from model.user import DbUser
+from services.quota_service import QuotaService
 from services.user_api_key_service import get_current_user_api_key_type_or_public
+from util.sse_util import sse_finished_task, sse_response, sse_task_events
 
 embedding_api_v1 = Blueprint(
     'embedding_api_v1', __name__, url_prefix='/v1/embedding')
@@ -50,12 +57,6 @@ def create_embedding_func():
     if created_by is None:
         return {"message": "No created_by id provided"}, 400
 
-    vector_store_params_dict = vector_store["parameters"]
-    vector_store_params_dict["db_path"] = current_app.config["VECTOR_STORE"]["db_path"]
-
-    llm_api_key_dict = {
-        "openai_api_key": get_current_user_api_key_type_or_public(ApiType.OPENAI.value)}
-
     embedding_config = {"doc_transformer": doc_transformer,
                         "embedding_model": embedding_model,
                         "vector_store": vector_store}
@@ -67,19 +68,15 @@ def create_embedding_func():
     if file_data is None:
         return {"message": "File not found"}, 400
 
-    text = file_data.content.get("text", None)
+    # Only file metadata is loaded here, the worker loads the text itself
+    if file_data.type == "Table":
+        return {"message": "Only text files can be embedded"}, 400
 
-    if text is None or len(text) == 0:
+    if not file_data.size:
         return {"message": "File is empty"}, 400
 
-    embedding_id = start_embedding_task(doc_transformer["type"],
-                                        doc_transformer["parameters"],
-                                        embedding_model["model_provider"],
-                                        embedding_model["parameters"],
-                                        vector_store["vector_store_provider"],
-                                        vector_store_params_dict,
-                                        text, embedding_name, created_by, file_id, llm_api_key_dict,
-                                        embedding_config)
+    # The worker loads the text and the API key itself, only references go through the broker
+    embedding_id = start_embedding_task(embedding_config, embedding_name, created_by, file_id)
 
     if embedding_id is None:
         return jsonify({"embedding_id": None, "success": False})
@@ -94,7 +91,7 @@ def embedding_task_status_func(embedding_id):
     embedding_build = DbEmbedding.query.filter(
         DbEmbedding.id == embedding_id,
         (DbEmbedding.created_by == g.current_user_id) |
-        (DbEmbedding.publish.is_(True))).first()
+        (DbEmbedding.published.is_(True))).first()
 
     if embedding_build is None:
         return {"message": "embedding id is invalid"}, 400
@@ -108,9 +105,13 @@ def embedding_task_status_func(embedding_id):
     else:
         status = TaskStatus.get_key_from_value(embedding_build_status)
 
-    if embedding_build_result is None:
-        progress = None
-    else:
+    # Running embeddings only write progress to Redis, the DB has it once they are finished
+    progress = None
+    if embedding_build_status in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value):
+        progress = TaskRedisRecords(embedding_id, total=-1,
+                                    prefix=EMBEDDING_TASK_PREFIX).get_progress()
+
+    if progress is None and embedding_build_result is not None:
         progress = embedding_build_result.get("progress", None)
 
     if embedding_build_message is None:
@@ -121,6 +122,32 @@ def embedding_task_status_func(embedding_id):
     return {"status": status, "progress": progress, "message": message}
 
 
+@embedding_api_v1.route('/progress_stream/<embedding_id>', methods=['GET'])
+@login_required
+def embedding_task_progress_stream_func(embedding_id):
+    """Embedding task progress stream function.
+
+    Pushes progress as Server-Sent Events while the embedding runs, so that clients do not
+    have to poll /status.
+    """
+    embedding_build = DbEmbedding.query.filter(
+        DbEmbedding.id == embedding_id,
+        (DbEmbedding.created_by == g.current_user_id) |
+        (DbEmbedding.published.is_(True))).first()
+
+    if embedding_build is None:
+        return {"message": "embedding id is invalid"}, 400
+
+    if embedding_build.status not in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value):
+        progress = embedding_build.result.get("progress", None) \
+            if embedding_build.result else None
+        return sse_response(sse_finished_task(
+            TaskStatus.get_key_from_value(embedding_build.status), progress))
+
+    records = TaskRedisRecords(embedding_id, total=-1, prefix=EMBEDDING_TASK_PREFIX)
+    return sse_response(sse_task_events(records, include_results=False))
+
+
 @embedding_api_v1.route('/stop/<embedding_id>', methods=['GET'])
 @login_required
 def stop_embedding_task_func(embedding_id):
@@ -146,6 +173,9 @@ def stop_embedding_task_func(embedding_id):
     embedding_build.status = TaskStatus.STOPPED.value
     embedding_build.completed_at = datetime.utcnow()
     db.session.commit()
+    progress_records = TaskRedisRecords(embedding_id, total=-1, prefix=EMBEDDING_TASK_PREFIX)
+    QuotaService.settle_user_quota(embedding_id, progress_records.get_task_progress())
+    progress_records.deactivate(TaskStatus.STOPPED.name)
 
     return jsonify({"success": True, "message": "embedding stopped"})
 
@@ -176,6 +206,11 @@ def list_embedding_task_func():
 
     embeddings = query.offset((page - 1) * size).limit(size).all()
 
+    live_progress_dict = TaskRedisRecords.get_progress_dict(
+        [t.id for t in embeddings
+         if t.status in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value)],
+        prefix=EMBEDDING_TASK_PREFIX)
+
     embedding_list = list(map(lambda t: {
         "id": t.id,
         "embedding_name": t.embedding_name,
@@ -185,7 +220,8 @@ def list_embedding_task_func():
         "created_at": t.created_at,
         "published": t.published,
         "status": TaskStatus.get_key_from_value(t.status),
-        "progress": t.result.get("progress", None) if t.result is not None else None,
+        "progress": live_progress_dict.get(t.id) or (
+            t.result.get("progress", None) if t.result is not None else None),
         "message": t.message.get("message", None) if t.message is not None else None,
         "completed_at": t.completed_at
     }, embeddings))
@@ -207,6 +243,7 @@ def delete_embedding_task_func(embedding_id):
 
     embedding_build.deleted_at = datetime.utcnow()
     db.session.commit()
+    invalidate_vector_store(embedding_id)
 
     return {"success": True, "message": "Embedding deleted successfully"}, 200
 
@@ -4,14 +4,23 @@ from math import ceil
 
 import requests
 import json
-import pandas as pd
-from flask import Blueprint, Response, request, jsonify, g
+from flask import Blueprint, Response, current_app, request, jsonify, g, send_file
+from sqlalchemy.orm import undefer
 from werkzeug.utils import secure_filename
 
 from connection import db
 from core.auth.authenticator import login_required, get_current_user
 from model.file import DbFile
 from model.user import DbUser
+from services.file_storage_service import (
+    MissingTableRowsError,
+    has_raw_file,
+    ingest_upload,
+    load_table_columns,
+    raw_file_path,
+    remove_file,
+    save_upload,
+)
 from util.uid_gen import gen_uuid
 
 file_api_v1 = Blueprint('file_api_v1', __name__, url_prefix='/v1/file')
@@ -47,21 +56,21 @@ def upload_file():
         filename = secure_filename(file.filename)
         file_id = gen_uuid()
 
-        # Check file size
-        file.seek(0)
-        content = file.read()
-        size = len(content)
-        if size > 1024 * 1024 * 15:  # 15MB
-            return jsonify(success=False, error='Only files smaller than 15MB are supported.'), 400
-
-        file_type, df_content, row_count = determine_file_type_and_content(
-            file)
-
-        # Check row count for table types
-        if file_type == "Table":
-            if row_count > 3000:
-                return jsonify(success=False,
-                               error='Only tables with less than 3000 rows are supported.'), 400
+        # The upload is streamed to storage and parsed from there, so it is never held in
+        # memory as a whole
+        try:
+            size = save_upload(file_id, file.stream,
+                               current_app.config["FILE_STORE"]["max_upload_size"])
+            file_type, content, _ = ingest_upload(file_id)
+        except ValueError as e:
+            remove_file(file_id)
+            return jsonify(success=False, error=str(e)), 400
+        except UnicodeDecodeError:
+            remove_file(file_id)
+            return jsonify(success=False, error='Only UTF-8 encoded files are supported.'), 400
+        except Exception:
+            remove_file(file_id)
+            raise
 
         uploaded_files = DbFile(
             id=file_id,
@@ -70,45 +79,24 @@ def upload_file():
             uploaded_by=uploaded_by,
             uploaded_at=datetime.utcnow(),
             size=size,
-            content=df_content,
-            raw_content=content,
+            content=content,
+            raw_content=None,
             published=False
         )
 
-        db.session.add(uploaded_files)
-        db.session.commit()
+        try:
+            db.session.add(uploaded_files)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            remove_file(file_id)
+            raise
 
         return jsonify(success=True, file_id=file_id), 200
 
     return jsonify(success=False, error='Invalid file type'), 400
 
 
-def determine_file_type_and_content(file):
-    """Determine if the file is a TSV table or plain text."""
-    file.seek(0)
-    first_line = file.readline().decode('utf-8')
-    file.seek(0)
-    delimiter = None
-    if '\t' in first_line:
-        delimiter = '\t'
-    elif ',' in first_line:
-        delimiter = ','
-    
-    if delimiter:
-        lines = file.readlines()
-        file.seek(0)
-        decoded_lines = [line.decode('utf-8') for line in lines]
-        delimiter_counts = [line.count(delimiter) for line in decoded_lines]
-        if len(set(delimiter_counts)) == 1 and delimiter_counts[0] > 0:
-            df = pd.read_csv(file, sep=delimiter)
-            row_count = df.shape[0]
-            file.seek(0)
-            return 'Table', df.to_dict(orient="records"), row_count
-    
-    text_content = file.read().decode('utf-8')
-    return 'Plain Text', {"text": text_content}, 0
-
-
 @file_api_v1.route('/list', methods=['GET'])
 @login_required
 def get_uploaded_files():
@@ -151,7 +139,7 @@ def load_file(file_id):
     if file_id is None:
         return jsonify(error='No file id provided'), 400
 
-    file_data = (DbFile.query.join(DbUser)
+    file_data = (DbFile.query.options(undefer(DbFile.content)).join(DbUser)
                              .filter(DbFile.id == file_id,
                                      DbFile.deleted_at.is_(None),
                                      (DbFile.uploaded_by == g.current_user_id) |
@@ -164,9 +152,10 @@ def load_file(file_id):
     file_data_dict['uploaded_by_username'] = file_data.user.username
 
     if file_data_dict['type'] == "Table":
-        content_list = file_data_dict['content']
-        df_content = pd.json_normalize(content_list)
-        file_data_dict['content'] = df_content.to_json(orient='columns')
+        try:
+            file_data_dict['content'] = json.dumps(load_table_columns(file_data))
+        except MissingTableRowsError as e:
+            return jsonify(error=str(e)), 404
     elif (file_data_dict['type'] == "Plain Text" or file_data_dict['type'] == "Embedded Text"):
         pass
 
@@ -190,6 +179,13 @@ def download_file(file_id):
         return jsonify(error='File not found or not authorized'), 404
 
     file_name = file_data.name
+
+    if has_raw_file(file_id):
+        response = send_file(raw_file_path(file_id), mimetype='application/octet-stream',
+                             as_attachment=True, download_name=file_name)
+        response.headers["X-File-Name"] = file_name
+        return response
+
     raw_content = file_data.raw_content
 
     response = Response(raw_content, mimetype='application/octet-stream')
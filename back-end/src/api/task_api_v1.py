@@ -4,59 +4,44 @@ from datetime import datetime
 from math import ceil
 
 from celery.result import AsyncResult
-from flask import Blueprint, request, jsonify, g
+from flask import Blueprint, Response, current_app, request, jsonify, g, stream_with_context
+from sqlalchemy.orm import defer
+from werkzeug.utils import secure_filename
 
 from connection import db
 from core.auth.authenticator import login_required, get_current_user
 from core.interface.ops_interface import (
+    adjust_action_list,
     text_convert,
     complete,
+    complete_stream,
     tag_parse,
     google_search,
     youtube_transcript,
     run_chain,
+    run_chain_stream,
     start_batch_task,
+    close_batch_task,
+    InsufficientQuotaException,
+    load_task_progress,
+    load_task_progress_dict,
+    load_task_result_page,
+    result_column_list,
 )
+from core.task_progress import TaskRedisRecords
 from model.application import DbAppBuild, DbAppTask, TaskStatus
 from model.file import DbFile
 from model.types import ApiType
 from model.user import DbUser
+from services.file_storage_service import MissingTableRowsError, count_table_rows
 from services.user_api_key_service import get_current_user_api_key_type_or_public
 from services.quota_service import QuotaService
+from services.task_export_service import EXPORT_MIMETYPES, iter_task_export
+from util.sse_util import sse, sse_finished_task, sse_response, sse_task_events
 
 task_api_v1 = Blueprint('task_api_v1', __name__, url_prefix='/v1/task')
 
 
-def _adjust_action_list(action_list):
-    index = 1
-    for action in action_list:
-        action["name"] = action["title"]
-        index += 1
-
-        if action["type"] in ApiType.values():
-            action["model_provider"] = action["type"]
-            action["type"] = "prompt"
-
-        if action["type"] == "batch-input":
-            action["type"] = "table"
-
-        if action["type"] in ("text-input", "output"):
-            action["type"] = "text"
-
-        if action["type"] == "tag-parser":
-            action["type"] = "tag_parser"
-            action["tag"] = action["parameters"]["extract_pattern"]
-
-        if action["type"] == "google-search":
-            action["type"] = "google_search"
-            action["num_results"] = action["parameters"]["num_results"]
-
-        if action["type"] == "doc-search":
-            action["type"] = "doc_search"
-
-    return action_list
-
-
 @task_api_v1.before_request
 @login_required
 def load_user_id():
@@ -120,6 +105,59 @@ def complete_func():
         return jsonify({"error": str(e)}), 403
 
 
+@task_api_v1.route('/complete_stream', methods=['POST'])
+@login_required
+def complete_stream_func():
+    """Complete function streaming tokens as Server-Sent Events."""
+    try:
+        data = json.loads(request.data)
+        user_id = g.current_user_id
+
+        quota_needed = QuotaService.calculate_model_quota(user_id, data)
+
+        llm_api_key_dict = {
+            "openai_api_key": get_current_user_api_key_type_or_public(ApiType.OPENAI.value),
+            "anthropic_api_key": get_current_user_api_key_type_or_public(ApiType.ANTHROPIC.value)
+        }
+
+        token_stream = complete_stream(
+            data["input"],
+            input_variables=data.get("input_variables", None),
+            model_provider=data["model_provider"],
+            params_dict=data["parameters"],
+            llm_api_key_dict=llm_api_key_dict
+        )
+        if token_stream is None:
+            return jsonify({"error": "Model provider is not supported."}), 400
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 403
+
+    # Charged before streaming, a client disconnecting midway has still used the model
+    quota_result, quota_status = QuotaService.update_user_quota(user_id, quota_needed)
+    if quota_status != 200:
+        return jsonify(quota_result), quota_status
+
+    # The stream runs outside the request's app context, which is only entered for a refund
+    app = current_app._get_current_object()
+
+    def generate():
+        token_list = []
+        try:
+            for token in token_stream:
+                token_list.append(token)
+                yield sse("token", {"token": token})
+        except Exception as e:
+            with app.app_context():
+                QuotaService.update_user_quota(user_id, -quota_needed)
+            yield sse("error", {"error": str(e)})
+            return
+
+        yield sse("result", {"result": "".join(token_list)})
+
+    return sse_response(generate())
+
+
 @task_api_v1.route('/tag_parse', methods=['POST'])
 @login_required
 def tag_parse_func():
@@ -128,7 +166,12 @@ def tag_parse_func():
     tag = data["tag"]
     text_template = data["input"]
     input_variables = data.get("input_variables", None)
-    res = tag_parse(tag, text_template, input_variables=input_variables)
+    occurrence = data.get("occurrence", 0)
+    try:
+        res = tag_parse(tag, text_template, input_variables=input_variables,
+                        occurrence=occurrence)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     return jsonify({"result": res})
 
@@ -188,7 +231,7 @@ def run_chain_func():
             "anthropic_api_key": get_current_user_api_key_type_or_public(ApiType.ANTHROPIC.value),
             "google_search_api_key": get_current_user_api_key_type_or_public(ApiType.GOOGLE_SEARCH.value)
         }
-        action_list = _adjust_action_list(action_list)
+        action_list = adjust_action_list(action_list)
 
         quota_needed = QuotaService.calculate_app_quota(user_id, action_list)
         current_quota = QuotaService.check_user_quota(user_id)
@@ -237,7 +280,7 @@ def run_chain_v2_func():
             return {"message": "No application found with given ID."}, 400
 
         action_list = app_build.chain
-        action_list = _adjust_action_list(action_list)
+        action_list = adjust_action_list(action_list)
 
         quota_needed = QuotaService.calculate_app_quota(user_id, action_list)
         current_quota = QuotaService.check_user_quota(user_id)
@@ -258,6 +301,69 @@ def run_chain_v2_func():
         return jsonify({"error": f"Missing key in request data: {str(e)}"}), 400
 
 
+@task_api_v1.route('/run_chain_v2_stream', methods=['POST'])
+@login_required
+def run_chain_v2_stream_func():
+    """Run chain V2 function streaming tokens and action results as Server-Sent Events."""
+    try:
+        data = json.loads(request.data)
+        app_id = data["app_id"]
+        user_id = g.current_user_id
+
+        input_variables = data.get("input_variables", None)
+        llm_api_key_dict = {
+            "openai_api_key": get_current_user_api_key_type_or_public(ApiType.OPENAI.value),
+            "anthropic_api_key": get_current_user_api_key_type_or_public(ApiType.ANTHROPIC.value),
+            "google_search_api_key": get_current_user_api_key_type_or_public(ApiType.GOOGLE_SEARCH.value)
+        }
+
+        app_build = DbAppBuild.query.filter(
+            DbAppBuild.id == app_id,
+            DbAppBuild.deleted_at.is_(None),
+            (DbAppBuild.created_by == g.current_user_id) |
+            (DbAppBuild.published.is_(True))).first()
+
+        if app_build is None:
+            return {"message": "No application found with given ID."}, 400
+
+        action_list = app_build.chain
+        action_list = adjust_action_list(action_list)
+
+        quota_needed = QuotaService.calculate_app_quota(user_id, action_list)
+
+        events = run_chain_stream(action_list, input_variables=input_variables,
+                                  llm_api_key_dict=llm_api_key_dict)
+        if events is None:
+            return jsonify({"error": "application load failure"}), 400
+
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 403
+
+    except KeyError as e:
+        return jsonify({"error": f"Missing key in request data: {str(e)}"}), 400
+
+    # Charged before streaming, a client disconnecting midway has still used the models
+    quota_result, quota_status = QuotaService.update_user_quota(user_id, quota_needed)
+    if quota_status != 200:
+        return jsonify(quota_result), quota_status
+
+    # The stream runs outside the request's app context, which is only entered for a refund
+    app = current_app._get_current_object()
+
+    def generate():
+        for event, event_data in events:
+            if event == "result":
+                yield sse(event, {"result": event_data})
+            elif event == "error":
+                with app.app_context():
+                    QuotaService.update_user_quota(user_id, -quota_needed)
+                yield sse(event, {"error": event_data})
+            else:
+                yield sse(event, event_data)
+
+    return sse_response(generate())
+
+
 @task_api_v1.route('/start', methods=['POST'])
 @login_required
 def start_batch_task_func():
@@ -273,11 +379,9 @@ def start_batch_task_func():
     created_at = datetime.utcnow()
 
     input_variables = data.get("input_variables", None)
-    llm_api_key_dict = {
-        "openai_api_key": get_current_user_api_key_type_or_public(ApiType.OPENAI.value),
-        "anthropic_api_key": get_current_user_api_key_type_or_public(ApiType.ANTHROPIC.value),
-        "google_search_api_key": get_current_user_api_key_type_or_public(ApiType.GOOGLE_SEARCH.value)
-    }
+    concurrency = data.get("concurrency", 1)
+    distributed = data.get("distributed", False)
+    chunk_size = data.get("chunk_size", None)
 
     app_build = DbAppBuild.query.filter(
         DbAppBuild.id == app_id,
@@ -295,17 +399,22 @@ def start_batch_task_func():
     if file_data is None:
         return {"message": "File not found"}, 400
 
-    action_list = app_build.chain
-    action_list = _adjust_action_list(action_list)
-
-    table_list = file_data.content
-
-    if table_list is None or len(table_list) == 0:
+    try:
+        row_count = count_table_rows(file_data)
+    except MissingTableRowsError as e:
+        return {"message": str(e)}, 400
+    if row_count == 0:
         return {"message": "File is empty"}, 400
 
-    task_id = start_batch_task(action_list, input_variables, table_list, task_name,
-                               created_by, created_at, app_id, file_id,
-                               llm_api_key_dict=llm_api_key_dict)
+    # The worker loads the application, the rows and the API keys from these references, the
+    # quota of every row is reserved before the task is queued
+    try:
+        task_id = start_batch_task(task_name, created_by, created_at, app_id, file_id,
+                                   input_variables=input_variables, concurrency=concurrency,
+                                   distributed=distributed, chunk_size=chunk_size,
+                                   row_count=row_count)
+    except InsufficientQuotaException as e:
+        return jsonify({"error": str(e)}), 403
     if task_id is None:
         return jsonify({"task_id": None, "success": False})
 
@@ -316,7 +425,7 @@ def start_batch_task_func():
 @login_required
 def batch_task_status_func(task_id):
     """Batch task status function."""
-    task_build = DbAppTask.query.filter(
+    task_build = DbAppTask.query.options(defer(DbAppTask.result)).filter(
         DbAppTask.id == task_id,
         DbAppTask.deleted_at.is_(None),
         (DbAppTask.created_by == g.current_user_id) |
@@ -326,7 +435,6 @@ def batch_task_status_func(task_id):
         return {"message": "Task id is invalid"}, 400
 
     task_build_status = task_build.status
-    task_build_result = task_build.result
     task_build_message = task_build.message
 
     if task_build_status is None:
@@ -334,10 +442,8 @@ def batch_task_status_func(task_id):
     else:
         status = TaskStatus.get_key_from_value(task_build_status)
 
-    if task_build_result is None:
-        progress = None
-    else:
-        progress = task_build_result.get("progress", None)
+    # Running tasks only write progress to Redis, the DB has it once they are finished
+    progress = load_task_progress(task_build)
 
     if task_build_message is None:
         message = None
@@ -347,11 +453,49 @@ def batch_task_status_func(task_id):
     return {"status": status, "progress": progress, "message": message}
 
 
+@task_api_v1.route('/progress_stream/<task_id>', methods=['GET'])
+@login_required
+def batch_task_progress_stream_func(task_id):
+    """Batch task progress stream function.
+
+    Pushes progress and row results as Server-Sent Events while the task runs, so that
+    clients do not have to poll /status.
+    """
+    task_build = DbAppTask.query.options(defer(DbAppTask.result)).filter(
+        DbAppTask.id == task_id,
+        DbAppTask.deleted_at.is_(None),
+        (DbAppTask.created_by == g.current_user_id) |
+        (DbAppTask.published.is_(True))).first()
+
+    if task_build is None:
+        return {"message": "Task id is invalid"}, 400
+
+    if task_build.status not in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value):
+        return sse_response(sse_finished_task(
+            TaskStatus.get_key_from_value(task_build.status), load_task_progress(task_build)))
+
+    include_results = request.args.get("results", "true").lower() != "false"
+    return sse_response(sse_task_events(TaskRedisRecords(task_id, total=-1), include_results))
+
+
 @task_api_v1.route('/load/<task_id>', methods=['GET'])
 @login_required
 def batch_task_load_func(task_id):
-    """Batch task load function."""
-    task_build = DbAppTask.query.join(DbUser).filter(
+    """Batch task load function.
+
+    offset and limit page through the result rows, columns (comma separated) projects them
+    and meta=true leaves them out. The result column is never loaded as a whole.
+    """
+    params = request.args
+    try:
+        offset = max(int(params.get('offset', 0)), 0)
+        limit = int(params['limit']) if 'limit' in params else None
+    except ValueError:
+        return jsonify({"message": "offset and limit must be integers"}), 400
+    column_list = [column for column in params.get('columns', '').split(',') if column]
+    meta_only = params.get('meta', 'false').lower() == 'true'
+
+    task_build = DbAppTask.query.options(defer(DbAppTask.result)).join(DbUser).filter(
         DbAppTask.id == task_id,
         DbAppTask.deleted_at.is_(None),
         (DbAppTask.created_by == g.current_user_id) |
@@ -359,39 +503,70 @@ def batch_task_load_func(task_id):
     if task_build is None:
         return jsonify({"message": "Task id is invalid"}), 400
 
-    # task_build_status = task_build.status
-    # task_build_result = task_build.result
-    #
-    # if task_build_status is None:
-    #     status = None
-    # else:
-    #     status = TaskStatus.get_key_from_value(task_build_status)
-    #
-    # if task_build_result is None:
-    #     result = None
-    # else:
-    #     result = task_build_result.get("result", None)
-
-    # return jsonify({"status": status, "result": result})
-
-    task_build_dict = task_build.as_dict()
+    task_build_dict = task_build.as_dict(exclude=['result'])
     task_build_dict['created_by_username'] = task_build.user.username
 
     if task_build.status is not None:
         task_build_dict["status"] = TaskStatus.get_key_from_value(
             task_build.status)
 
-    if 'result' in task_build_dict and task_build_dict['result']:
-        sample_result = {}
-        if task_build_dict['result']['result']:
-            sample_result = task_build_dict['result']['result'][0]
-        task_build_dict['column_order'] = list(sample_result.keys())
-    else:
-        task_build_dict['column_order'] = []
+    # The column order comes from the first row alone, failed rows have the same outputs
+    sample_result_list = load_task_result_page(task_build, 0, 1)
+    column_order = result_column_list(task_build, sample_result_list[0][1]) \
+        if sample_result_list else []
+    if column_list:
+        column_order = [column for column in column_list if column in column_order]
+    task_build_dict['column_order'] = column_order
+
+    task_build_dict['result'] = {"progress": load_task_progress(task_build)}
+    if not meta_only:
+        row_list = load_task_result_page(task_build, offset, limit)
+        result_list = [res for _, res in row_list]
+        if column_list:
+            result_list = [{column: res.get(column) for column in column_order}
+                           for res in result_list]
+        task_build_dict['result']['result'] = result_list
+        # Rows that are not done yet are missing, row_index places each result in the file
+        task_build_dict['result']['row_index'] = [row_index for row_index, _ in row_list]
+        task_build_dict['offset'] = offset
+        task_build_dict['limit'] = limit
 
     return jsonify(task_build_dict)
 
 
+@task_api_v1.route('/export/<task_id>', methods=['GET'])
+@login_required
+def export_batch_task_func(task_id):
+    """Export batch task function.
+
+    Streams the rows of the task file joined with their results as csv, tsv, jsonl or
+    parquet, chosen with the format parameter.
+    """
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({"message": f"format must be one of {', '.join(EXPORT_MIMETYPES)}"}), 400
+
+    task_build = DbAppTask.query.options(defer(DbAppTask.result)).filter(
+        DbAppTask.id == task_id,
+        DbAppTask.deleted_at.is_(None),
+        (DbAppTask.created_by == g.current_user_id) |
+        (DbAppTask.published.is_(True))).first()
+    if task_build is None:
+        return jsonify({"message": "Task id is invalid"}), 400
+
+    file_data = DbFile.query.get(task_build.file_id)
+    if file_data is None:
+        return jsonify({"message": "File not found"}), 400
+
+    chunks = iter_task_export(task_build, file_data, export_format,
+                              current_app.config.get("TASK_EXPORT_PAGE_SIZE", 500))
+    response = Response(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[export_format])
+    file_name = f"{secure_filename(task_build.task_name) or task_id}.{export_format}"
+    response.headers["Content-Disposition"] = f'attachment; filename="{file_name}"'
+    response.headers["X-File-Name"] = file_name
+    return response
+
+
 @task_api_v1.route('/stop/<task_id>', methods=['GET'])
 @login_required
 def stop_batch_task_func(task_id):
@@ -404,21 +579,20 @@ def stop_batch_task_func(task_id):
     if task_build is None:
         return jsonify({"message": "Task id is invalid"}), 400
 
-    # Create AsyncResult object
-    async_result = AsyncResult(task_id)
-
-    # Check if the task is already completed
-    if async_result.ready():
+    # The task record decides, the Celery state of batch tasks is not kept and distributed
+    # tasks return as soon as their chunks are dispatched
+    if task_build.status not in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value):
         # Task is already completed, no need to terminate
         return jsonify({"success": False, "message": "task completed"})
 
+    # Create AsyncResult object
+    async_result = AsyncResult(task_id)
+
     # Terminate the task
     async_result.revoke(terminate=True, signal="SIGTERM", wait=True, timeout=5)
 
-    # Task successfully terminated
-    task_build.status = TaskStatus.STOPPED.value
-    task_build.completed_at = datetime.utcnow()
-    db.session.commit()
+    # Task successfully terminated, the rows done so far are kept
+    close_batch_task(task_build, TaskStatus.STOPPED)
 
     return jsonify({"success": True, "message": "task stopped"})
 
@@ -434,8 +608,9 @@ def list_batch_task_func():
     app_id = params.get('app_id', None)
     file_id = params.get('file_id', None)
 
-    query = DbAppTask.query.join(DbUser).filter(DbAppTask.deleted_at.is_(
-        None), (DbAppTask.created_by == g.current_user_id) |
+    query = DbAppTask.query.options(defer(DbAppTask.result)).join(DbUser).filter(
+        DbAppTask.deleted_at.is_(None),
+        (DbAppTask.created_by == g.current_user_id) |
         (DbAppTask.published.is_(True))).order_by(DbAppTask.created_at.desc())
 
     if created_by is not None:
@@ -453,6 +628,8 @@ def list_batch_task_func():
 
     tasks = query.offset((page - 1) * size).limit(size).all()
 
+    progress_dict = load_task_progress_dict(tasks)
+
     task_list = list(map(lambda t: {
         "id": t.id,
         "task_name": t.task_name,
@@ -462,7 +639,7 @@ def list_batch_task_func():
         "file_id": t.file_id,
         "created_at": t.created_at,
         "published": t.published,
-        "progress": t.result.get("progress", None) if t.result is not None else None,
+        "progress": progress_dict.get(t.id),
         "message": t.message.get("message", None) if t.message is not None else None,
         "status": TaskStatus.get_key_from_value(t.status),
         "completed_at": t.completed_at
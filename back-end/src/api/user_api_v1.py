@@ -4,13 +4,15 @@ from flask import Blueprint, request
 from werkzeug.exceptions import BadRequest
 
 from connection import db
-from core.auth.authenticator import login_required, get_current_user
+from core.auth.auth_cache import auth_cache
+from core.auth.authenticator import login_required, get_current_user, get_current_token_key
 from core.auth.token import JwtToken
 from model.types import ApiType
 from model.user import DbUser, DbUserApiKey, DbUserQuota
 from services.user_api_key_service import (
     get_current_user_api_keys,
     get_current_user_specified_api_key,
+    invalidate_user_api_keys,
 )
 from util.resp import response
 
@@ -92,6 +94,7 @@ def logout():
     # and reject tokens that have been revoked.
 
     # Here, we'll just return a success message
+    auth_cache.invalidate(get_current_token_key())
     return response("Logout successful."), 200
 
 
@@ -114,6 +117,8 @@ def register_api_key_for_user():
     user_key.api_type = api_type
     user_key.api_key = api_key
     db.session.commit()
+    auth_cache.invalidate_user(get_current_user().get_id())
+    invalidate_user_api_keys(get_current_user().get_id())
 
     return response("User's api-key registered.")
 
@@ -134,6 +139,8 @@ def delete_user_api_key():
         return response("Api key does not exist!", False), 400
     db.session.delete(user_key)
     db.session.commit()
+    auth_cache.invalidate_user(get_current_user().get_id())
+    invalidate_user_api_keys(get_current_user().get_id())
     return response("User's api-key removed!")
 
 
@@ -4,7 +4,6 @@ import os
 import langchain
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
-from langchain.cache import InMemoryCache
 
 from api.app_api_v1 import app_api_v1
 from api.file_api_v1 import file_api_v1
@@ -15,6 +14,9 @@ from api.embedding_api_v1 import embedding_api_v1
 from api.shared_link_api_v1 import shared_link_api_v1
 from config import DevelopmentConfig, app
 from connection import db
+from core.auth.auth_cache import configure_auth_cache
+from core.llm_processor.embedding_cache import configure_query_embedding_cache
+from core.llm_processor.llm_cache import build_llm_cache
 from util.celery_init import celery_init_app
 
 
@@ -28,7 +30,9 @@ jwt = JWTManager(app)
 celery_app = celery_init_app(app)
 
 db.init_app(app)
-langchain.llm_cache = InMemoryCache()
+langchain.llm_cache = build_llm_cache(app.config["LLM_CACHE"])
+configure_query_embedding_cache(app.config["EMBEDDING_CACHE"])
+configure_auth_cache(app.config["AUTH_CACHE"])
 
 # print(os.getenv("OPENAI_API_KEY"))
 # openai.api_key = os.getenv("OPENAI_API_KEY")
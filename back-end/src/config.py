@@ -17,6 +17,34 @@ class BaseConfig:
     DRIVER = 'pymysql'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = True
+    # Upper bound of chain actions executed concurrently within a single chain run
+    CHAIN_MAX_WORKERS = 4
+    # Ceiling for the per-task row concurrency of batch tasks
+    BATCH_TASK_MAX_CONCURRENCY = 8
+    # Rows of batch tasks running at once in one worker process, shared by all the tasks and
+    # chunks it runs. Each row runs up to CHAIN_MAX_WORKERS actions at once, so a process makes
+    # at most BATCH_PROCESS_MAX_CONCURRENT_ROWS * CHAIN_MAX_WORKERS concurrent model calls.
+    BATCH_PROCESS_MAX_CONCURRENT_ROWS = 8
+    # Rows of a batch task running or done but waiting for an earlier row, per concurrent row
+    BATCH_TASK_ROW_WINDOW_FACTOR = 4
+    # Rows per subtask when a batch task is fanned out across workers
+    BATCH_TASK_CHUNK_SIZE = 100
+    # Rows of a batch task hitting rate limits, timeouts or provider errors are retried this
+    # many times, waiting exponentially longer from the base delay up to the max delay. Rows
+    # still failing are recorded as failed and the task goes on.
+    BATCH_ROW_MAX_RETRIES = 3
+    BATCH_ROW_RETRY_BASE_DELAY_SEC = 2
+    BATCH_ROW_RETRY_MAX_DELAY_SEC = 60
+    # Row results written to t_task_result per INSERT statement once a batch task completes
+    TASK_RESULT_INSERT_SIZE = 500
+    # Task progress streams send a heartbeat after this many idle seconds and are closed after
+    # the max duration, for the client to reconnect
+    TASK_EVENT_HEARTBEAT_SEC = 15
+    TASK_EVENT_STREAM_MAX_SEC = 3600
+    # Result rows read and written per chunk of a task export
+    TASK_EXPORT_PAGE_SIZE = 500
+    # Document chunks embedded and written to the vector store per batch
+    EMBEDDING_BATCH_SIZE = 100
 
 
 # pylint: disable=too-few-public-methods
@@ -31,14 +59,65 @@ class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = DB_URI
     SECRET_KEY = secrets.token_urlsafe(32)
     REDIS_HOST = "localhost"
-    REDIS_PORT = 3306
+    REDIS_PORT = 6379
     CELERY = {
         'broker_url': 'redis://localhost:6379/0',
-        'result_backend': 'redis://localhost:6379/1'
+        'result_backend': 'redis://localhost:6379/1',
+        # Run the worker with -B (beat) for these, see celery_worker.py
+        'beat_schedule': {
+            'flush-quota-ledger': {
+                'task': 'services.quota_ledger.flush_quota_ledger',
+                'schedule': 30.0
+            }
+        }
+    }
+    QUOTA_LEDGER = {
+        # Users' quota is spent in Redis and flushed to the DB by the beat task above, a
+        # ledger entry without unflushed spending is dropped after idle_ttl seconds
+        'idle_ttl': 300
     }
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+    LLM_CACHE = {
+        # "redis" shares responses between the server and workers, "sqlite" keeps them
+        # in a local file (no eviction), None disables caching
+        'backend': 'redis',
+        'ttl': 7 * 24 * 3600,
+        'max_entries': 100000,
+        'database_path': os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      "llm_cache/langchain.db")
+    }
+    AUTH_CACHE = {
+        # Authenticated tokens and their users kept per process, a falsy ttl disables it
+        'ttl': 60,
+        'max_size': 10000
+    }
+    USER_API_KEY_CACHE = {
+        # API keys are resolved once per request or task, set 'redis' to also share them
+        # between processes for 'ttl' seconds (the keys are then stored in Redis in plain text)
+        'redis': False,
+        'ttl': 60
+    }
+    EMBEDDING_CACHE = {
+        # Query embeddings kept per process as packed float32 (about 6 KB each at 1536
+        # dimensions), and in Redis as well when 'redis' is set
+        'max_size': 4096,
+        'redis': True,
+        'ttl': 7 * 24 * 3600
+    }
     VECTOR_STORE = {
-        'db_path': os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_store/lancedb")
+        'db_path': os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_store/lancedb"),
+        # Tables with at least this many rows get an IVF-PQ index, None disables indexing
+        'index_row_threshold': 10000
+    }
+    FILE_STORE = {
+        'root_path': os.path.join(os.path.dirname(os.path.abspath(__file__)), "file_store"),
+        'max_upload_size': 100 * 1024 * 1024,  # 100MB
+        # Plain text is kept in the content column, in memory and in a single DB write
+        'max_text_size': 15 * 1024 * 1024,  # 15MB
+        'max_table_rows': 100000,
+        # Bytes read to tell tables from plain text, and rows written to storage at a time
+        'sniff_size': 64 * 1024,
+        'row_chunk_size': 1000
     }
 
 
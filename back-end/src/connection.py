@@ -6,6 +6,6 @@ from config import app
 
 db = SQLAlchemy()
 
-redis_host = app.config.get("REDIS_HOST")
-redis_port = app.config.get("REDIS_PORT")
+redis_host = app.config.get("REDIS_HOST", "localhost")
+redis_port = app.config.get("REDIS_PORT", 6379)
 r = redis.Redis(host=redis_host, port=redis_port)
@@ -0,0 +1,78 @@
+"""Auth cache."""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from util.timestamp_util import has_passed_timestamp
+
+
+class AuthCache:
+    """Bounded per-process cache of authenticated tokens, keyed by token digest.
+
+    An entry keeps the decoded token and a detached copy of its user for a short TTL, so
+    repeated requests with the same token skip the JWT decode, the payload decryption and
+    the user lookup. Entries never outlive their token.
+    """
+
+    def __init__(self, ttl=60, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token_str):
+        """Cache key of a raw token string."""
+        return hashlib.sha256(token_str.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Get the cached (token, user) of a key, or None."""
+        if not self.ttl:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            token, user, cached_at = entry
+            if time.monotonic() - cached_at > self.ttl or \
+                    has_passed_timestamp(float(token.expire_timestamp)):
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return token, user
+
+    def set(self, key, token, user):
+        """Cache a token and its detached user."""
+        if not self.ttl:
+            return
+
+        with self._lock:
+            self._entries[key] = (token, user, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drop the entry of a token."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_user(self, user_id):
+        """Drop the entries of every token of a user."""
+        with self._lock:
+            for key in [key for key, (token, _, _) in self._entries.items()
+                        if token.user_id == user_id]:
+                del self._entries[key]
+
+
+auth_cache = AuthCache()
+
+
+def configure_auth_cache(cache_config):
+    """Configure the process-wide auth cache."""
+    auth_cache.ttl = cache_config.get("ttl", 60)
+    auth_cache.max_size = cache_config.get("max_size", 10000)
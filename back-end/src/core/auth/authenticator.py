@@ -3,6 +3,8 @@ from functools import wraps
 
 from flask import request, g
 
+from connection import db
+from core.auth.auth_cache import auth_cache
 from core.auth.extractor import JwtTokenExtractor
 from core.auth.token import JwtToken
 from services.user_service import get_user_by_id
@@ -16,7 +18,11 @@ class Authenticator:
 
     def authenticate(self, req) -> JwtToken:
         """Authenticate."""
-        token = self.extract_token_from_request(req)
+        return self.authenticate_token_str(self.extract_token_str_from_request(req))
+
+    def authenticate_token_str(self, token_str) -> JwtToken:
+        """Authenticate a raw token string."""
+        token = JwtToken.digest(token_str)
         self.assert_login_uniqueness(token)
         self.assert_token_version_up_to_date(token)
 
@@ -39,6 +45,10 @@ class Authenticator:
         """Extract token from request."""
         return self._token_extractor.extract_from(req)
 
+    def extract_token_str_from_request(self, req):
+        """Extract the raw token string from request."""
+        return self._token_extractor.extract_token_str_from(req)
+
 
 authenticator = Authenticator(JwtTokenExtractor())
 
@@ -53,6 +63,30 @@ def set_current_user(user):
     g.current_user = user
 
 
+def get_current_token_key():
+    """Get the auth cache key of the token of the current request."""
+    return g.current_token_key
+
+
+def authenticate_request(req):
+    """Authenticate a request, from the auth cache when its token was seen recently."""
+    token_str = authenticator.extract_token_str_from_request(req)
+    key = auth_cache.key(token_str)
+    cached = auth_cache.get(key)
+    if cached is None:
+        token = authenticator.authenticate_token_str(token_str)
+        user = get_user_by_id(token.user_id)
+        # The cached user is detached so that it outlives the request session, every request
+        # merges it into its own session without a query
+        db.session.expunge(user)
+        auth_cache.set(key, token, user)
+    else:
+        token, user = cached
+
+    g.current_token_key = key
+    return token, db.session.merge(user, load=False)
+
+
 def login_required(f):
     """Login required."""
     @wraps(f)
@@ -60,10 +94,10 @@ def login_required(f):
         # NOTES:
         # Obsoleted Chengdu third part login validation.
         # But keeping the code for the other third part login.\
-        token = authenticator.authenticate(request)
-        set_current_user(
-            get_user_by_id(token.user_id)
-        )
+        # Blueprint hooks and their routes are both decorated, authenticate once per request
+        if g.get("current_user") is None:
+            _, user = authenticate_request(request)
+            set_current_user(user)
         return f(*args, **kw)
 
     return wrapper
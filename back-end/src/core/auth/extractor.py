@@ -17,6 +17,10 @@ class JwtTokenExtractor:
 
     def extract_from(self, flask_request):
         """Extract from."""
+        return JwtToken.digest(self.extract_token_str_from(flask_request))
+
+    def extract_token_str_from(self, flask_request):
+        """Extract the raw token string, without digesting it."""
         if type(flask_request) is not type(request):
             raise TypeError("input item is not a flask request(LocalProxy)")
 
@@ -42,4 +46,4 @@ class JwtTokenExtractor:
         token_str = parsed_token[0]
         if token_str.startswith("Bearer "):
             token_str = token_str[len("Bearer "):]
-        return JwtToken.digest(token_str)
+        return token_str
@@ -1,13 +1,21 @@
 """Chain."""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
 from config import logger
 
+DEFAULT_MAX_WORKERS = 4
+
+ACTION_TYPES = ("table", "text", "prompt", "parser", "google_search", "youtube_transcript",
+                "doc_search")
+
 
 class Chain:
     """Chain."""
 
-    def __init__(self):
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
         self.action_list = []
         self.length = 0
+        self.max_workers = max_workers
 
     def add_text(self, text_obj, name, is_input=False, is_output=True):
         """Add text."""
@@ -35,7 +43,19 @@ class Chain:
     def add_google_search(self, google_search_obj, text_obj, name, is_input=False, is_output=True):
         """Add Google search."""
         self.action_list.append(
-            {"type": "parser", "object": google_search_obj, "text_obj": text_obj, "name": name,
+            {"type": "google_search", "object": google_search_obj, "text_obj": text_obj,
+             "name": name,
+             "is_input": is_input,
+             "is_output": is_output})
+        self.length += 1
+
+    # pylint: disable=too-many-arguments
+    def add_youtube_transcript(self, youtube_transcript_obj, text_obj, name, is_input=False,
+                               is_output=True):
+        """Add YouTube transcript."""
+        self.action_list.append(
+            {"type": "youtube_transcript", "object": youtube_transcript_obj, "text_obj": text_obj,
+             "name": name,
              "is_input": is_input,
              "is_output": is_output})
         self.length += 1
@@ -55,84 +75,164 @@ class Chain:
              "is_output": is_output})
         self.length += 1
 
-    def run(self, input_variables=None):
-        """Run."""
+    def output_names(self):
+        """Names of the outputs run returns, in order."""
+        name_list = []
+        for action in self.action_list:
+            if not action["is_output"]:
+                continue
+            if action["type"] == "table":
+                name_list.extend(action["object"].scheme)
+            elif action["type"] in ACTION_TYPES:
+                name_list.append(action["name"])
+        return name_list
+
+    def run(self, input_variables=None, callback=None):
+        """Run.
+
+        Actions are scheduled as a DAG: an action waits only for the earlier actions whose
+        names it references, so independent branches run concurrently on the thread pool.
+        The optional callback receives ("token", ...) events while prompts stream and an
+        ("action", ...) event whenever an action completes.
+        """
         if input_variables is None:
             input_variables = {}
 
-        chain_outputs = {}
-        count = 1
+        dependency_list = self._build_dependency_list()
+        results = {}
 
-        for action in self.action_list:
-            logger.debug(f"Chain Action {count} Start")
+        if self.max_workers <= 1:
+            for index in range(self.length):
+                results[index] = self._run_action(
+                    index, self._resolve_variables(index, dependency_list, input_variables,
+                                                   results), callback)
+                self._notify_action(index, results[index], callback)
+        else:
+            self._run_parallel(dependency_list, input_variables, results, callback)
+
+        chain_outputs = {}
+        for index, action in enumerate(self.action_list):
+            res = results.get(index)
             if action["type"] == "table":
-                res = action["object"].load_variables(
-                    input_variables=input_variables)
                 input_variables.update(res)
-                logger.debug(res)
-
                 if action["is_output"]:
                     chain_outputs.update(res)
-            elif action["type"] == "text":
-                name = action["name"]
-                res = action["object"].text_convert(
-                    input_variables=input_variables)
-                input_variables[name] = res
-                logger.debug(res)
-
-                if action["is_output"]:
-                    chain_outputs[name] = res
-            elif action["type"] == "prompt":
-                text_obj = action["text_obj"]
-                name = action["name"]
-                res = action["object"].complete(
-                    text_obj, input_variables=input_variables)
-                input_variables[name] = res
-                logger.debug(res)
-
-                if action["is_output"]:
-                    chain_outputs[name] = res
-            elif action["type"] == "parser":
-                text_obj = action["text_obj"]
-                name = action["name"]
-                res = action["object"].parse(
-                    text_obj, input_variables=input_variables)
-                input_variables[name] = res
-                logger.debug(res)
-
-                if action["is_output"]:
-                    chain_outputs[name] = res
-            elif action["type"] == "google_search":
-                text_obj = action["text_obj"]
-                name = action["name"]
-                res = action["object"].search(
-                    text_obj, input_variables=input_variables)
-                input_variables[name] = res
-                logger.debug(res)
-
-                if action["is_output"]:
-                    chain_outputs[name] = res
-            elif action["type"] == "youtube_transcript":
-                text_obj = action["text_obj"]
+            elif action["type"] in ACTION_TYPES:
                 name = action["name"]
-                res = action["object"].get_transcript(
-                    text_obj, input_variables=input_variables)
                 input_variables[name] = res
-                logger.debug(res)
-
                 if action["is_output"]:
                     chain_outputs[name] = res
-            elif action["type"] == "doc_search":
-                name = action["name"]
-                res = action["object"].search(
-                    input_variables=input_variables)
-                input_variables[name] = res
-                logger.debug(res)
-
-                if action["is_output"]:
-                    chain_outputs[name] = res
-
-            logger.debug(f"Chain action {count} completed")
-            count += 1
 
         return chain_outputs
+
+    def _run_parallel(self, dependency_list, input_variables, results, callback=None):
+        """Run actions concurrently as soon as their dependencies are resolved."""
+        remaining = list(range(self.length))
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            try:
+                while remaining or pending:
+                    ready = [index for index in remaining
+                             if dependency_list[index].issubset(results)]
+                    for index in ready:
+                        remaining.remove(index)
+                        variables = self._resolve_variables(
+                            index, dependency_list, input_variables, results)
+                        future = executor.submit(self._run_action, index, variables, callback)
+                        pending[future] = index
+
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = pending.pop(future)
+                        results[index] = future.result()
+                        self._notify_action(index, results[index], callback)
+            except Exception:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def _resolve_variables(self, index, dependency_list, input_variables, results):
+        """Variables visible to an action: the inputs plus its dependencies' outputs."""
+        variables = dict(input_variables)
+        for dependency in sorted(dependency_list[index]):
+            variables[self.action_list[dependency]["name"]] = results[dependency]
+        return variables
+
+    def _build_dependency_list(self):
+        """Build dependency list.
+
+        An action depends on the latest earlier action producing each variable referenced in
+        its template, which is exactly what it would have observed when run in list order.
+        """
+        producers = {}
+        dependency_list = []
+
+        for index, action in enumerate(self.action_list):
+            dependencies = set()
+            for variable in self._referenced_variables(action):
+                if variable in producers:
+                    dependencies.add(producers[variable])
+            dependency_list.append(dependencies)
+
+            if action["type"] != "table":
+                producers[action["name"]] = index
+
+        return dependency_list
+
+    @staticmethod
+    def _referenced_variables(action):
+        """Referenced variables."""
+        if action["type"] in ("text", "doc_search"):
+            return action["object"].compiled_template.variables
+        if "text_obj" in action:
+            return action["text_obj"].compiled_template.variables
+        return frozenset()
+
+    def _notify_action(self, index, res, callback):
+        """Notify the callback of a completed action."""
+        if callback is None:
+            return
+
+        action = self.action_list[index]
+        callback("action", {"name": action["name"], "result": res,
+                            "is_output": action["is_output"]})
+
+    def _run_action(self, index, input_variables, callback=None):
+        """Run a single action."""
+        action = self.action_list[index]
+        logger.debug(f"Chain Action {index + 1} Start")
+
+        res = None
+        if action["type"] == "table":
+            res = action["object"].load_variables(
+                input_variables=input_variables)
+        elif action["type"] == "text":
+            res = action["object"].text_convert(
+                input_variables=input_variables)
+        elif action["type"] == "prompt":
+            on_token = None
+            if callback is not None:
+                def notify_token(token):
+                    callback("token", {"name": action["name"], "token": token})
+                on_token = notify_token
+
+            res = action["object"].complete(
+                action["text_obj"], input_variables=input_variables, on_token=on_token)
+        elif action["type"] == "parser":
+            res = action["object"].parse(
+                action["text_obj"], input_variables=input_variables)
+        elif action["type"] == "google_search":
+            res = action["object"].search(
+                action["text_obj"], input_variables=input_variables)
+        elif action["type"] == "youtube_transcript":
+            res = action["object"].get_transcript(
+                action["text_obj"], input_variables=input_variables)
+        elif action["type"] == "doc_search":
+            res = action["object"].search(
+                input_variables=input_variables)
+
+        logger.debug(res)
+        logger.debug(f"Chain action {index + 1} completed")
+
+        return res
@@ -1,25 +1,27 @@
 """Doc search."""
 from config import logger
-from core.component.utils import generate_valid_prompt
+from core.component.utils import compile_template
 
 
 # pylint: disable=too-few-public-methods
 class DocSearch:
     """Doc search."""
 
-    def __init__(self, vector_store, text_template, top_n):
+    # pylint: disable=too-many-arguments
+    def __init__(self, vector_store, text_template, top_n, nprobes=None, refine_factor=None):
         self.vector_store = vector_store
         self.text_template = text_template
+        self.compiled_template = compile_template(text_template)
         self.top_n = top_n
+        self.nprobes = nprobes
+        self.refine_factor = refine_factor
 
     def search(self, input_variables=None):
         """Search."""
-        valid_prompt, valid_input_variables = generate_valid_prompt(
-            self.text_template, input_variables)
+        query = self.compiled_template.render(input_variables)
 
-        query = valid_prompt.format(**valid_input_variables)
-
-        res = self.vector_store.similarity_search(query, k=self.top_n)
+        res = self.vector_store.similarity_search(query, k=self.top_n, nprobes=self.nprobes,
+                                                  refine_factor=self.refine_factor)
 
         logger.debug(f"Query: {query}\n")
         logger.debug(f"Similar Docs: {res}\n")
@@ -1,42 +1,69 @@
 """Parser."""
-from langchain.output_parsers import RegexParser
+import re
+from functools import lru_cache
 
 from config import logger
 
+# Occurrence selecting every tag instead of a single one
+ALL_OCCURRENCES = "all"
 
-# Helper function to make the tag case-insensitive
-def make_case_insensitive(tag):
-    return ''.join(['[{}{}]'.format(c.lower(), c.upper()) for c in tag])
+
+@lru_cache(maxsize=256)
+def compile_tag_pattern(tag):
+    """Compile the case-insensitive pattern matching the content of a tag."""
+    escaped_tag = re.escape(tag)
+    return re.compile(fr"<\s*{escaped_tag}\s*>([\s\S]*?)<\s*/{escaped_tag}\s*>", re.IGNORECASE)
 
 
 # pylint: disable=too-few-public-methods
 class TagParser:
-    """Tag parser."""
+    """Tag parser.
+
+    Extracts the content of the occurrence-th tag (negative indexes count from the end), or of
+    every tag joined by newlines when occurrence is "all".
+    """
 
-    def __init__(self, tag):
+    def __init__(self, tag, occurrence=0):
         self.tag = tag
+        self.occurrence = self._validate_occurrence(occurrence)
+        self.pattern = compile_tag_pattern(tag)
+
+    @staticmethod
+    def _validate_occurrence(occurrence):
+        """Validate occurrence, an integer (possibly as a string) or "all"."""
+        if isinstance(occurrence, str) and occurrence.strip().lower() == ALL_OCCURRENCES:
+            return ALL_OCCURRENCES
+        if not isinstance(occurrence, bool):
+            try:
+                return int(occurrence)
+            except (TypeError, ValueError):
+                pass
+        raise ValueError(f'occurrence must be an integer or "{ALL_OCCURRENCES}", '
+                         f'got {occurrence!r}')
 
-    def _construct_tag_parser(self, output_key):
-        # Make the tag case-insensitive
-        tag_insensitive = make_case_insensitive(self.tag)
-        
-        # Create a RegexParser with the case-insensitive and multiline regex
-        parser = RegexParser(
-            regex=fr"<\s*{tag_insensitive}\s*>([\s\S]*?)<\s*/{tag_insensitive}\s*>",
-            output_keys=[output_key])
+    def extract(self, text):
+        """Extract the selected tag content from text."""
+        if self.occurrence == ALL_OCCURRENCES:
+            return "\n".join(self.pattern.findall(text))
 
-        return parser
+        if self.occurrence == 0:
+            match = self.pattern.search(text)
+            return match.group(1) if match else None
+
+        match_list = self.pattern.findall(text)
+        try:
+            return match_list[self.occurrence]
+        except IndexError:
+            return None
 
     def parse(self, text_obj, input_variables=None):
         """Parse."""
         text = text_obj.text_convert(input_variables=input_variables)
 
-        parser = self._construct_tag_parser("parser_output")
-        try:
-            res = parser.parse(text).get("parser_output", "")
-        except ValueError as e:
+        res = self.extract(text)
+        if res is None:
             res = ""
-            logger.error(e)
+            logger.error(f"Could not find occurrence {self.occurrence} of tag {self.tag}")
 
         logger.debug(f"Raw Text: {text}")
         logger.debug(f"Target Tag: {self.tag}")
@@ -1,6 +1,6 @@
 """Prompt."""
 from config import logger
-from core.component.utils import generate_valid_prompt
+from util.async_util import iterate_async
 
 
 # pylint: disable=too-few-public-methods
@@ -10,12 +10,26 @@ class Prompt:
     def __init__(self, llm_processor):
         self.llm_processor = llm_processor
 
-    def complete(self, text_obj, input_variables=None):
-        """Complete."""
+    def complete(self, text_obj, input_variables=None, on_token=None):
+        """Complete.
+
+        With on_token, the completion is streamed and every token is passed to it as it arrives.
+        """
         text = text_obj.text_convert(input_variables=input_variables)
 
-        res = self.llm_processor.complete(text)
+        if on_token is None:
+            res = self.llm_processor.complete(text)["result"]
+        else:
+            token_list = []
+            for token in self.stream(text):
+                token_list.append(token)
+                on_token(token)
+            res = "".join(token_list)
 
         logger.debug(f"Text: {text}\n")
 
-        return res["result"]
+        return res
+
+    def stream(self, text):
+        """Stream the completion of a rendered text."""
+        return iterate_async(self.llm_processor.astream(text))
@@ -1,6 +1,6 @@
 """Text."""
 from config import logger
-from core.component.utils import generate_valid_prompt
+from core.component.utils import compile_template
 
 
 # pylint: disable=too-few-public-methods
@@ -9,15 +9,13 @@ class Text:
 
     def __init__(self, text_template):
         self.text_template = text_template
+        self.compiled_template = compile_template(text_template)
 
     def text_convert(self, input_variables=None):
         """Text convert."""
-        valid_prompt, valid_input_variables = generate_valid_prompt(
-            self.text_template, input_variables)
-        res = valid_prompt.format(**valid_input_variables)
+        res = self.compiled_template.render(input_variables)
 
-        logger.debug(f"Text: {valid_prompt.template}\n")
-        logger.debug(f"Input Variables: {valid_input_variables}\n")
+        logger.debug(f"Text: {self.text_template}\n")
         logger.debug(f"Final Text: {res}\n")
 
         return res
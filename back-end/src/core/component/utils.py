@@ -1,27 +1,44 @@
 """Utils."""
-from langchain.prompts import PromptTemplate
+import re
+from functools import lru_cache
 
+PLACEHOLDER_PATTERN = re.compile(r"\{([^{}]*)\}")
 
-def generate_valid_prompt(text, input_variables=None):
-    """Generate valid prompt."""
-    if input_variables is None:
-        input_variables = {}
 
-    def replace_placeholders(template, variables):
-        for key, value in variables.items():
-            placeholder = f"{{{key}}}"
-            template = template.replace(placeholder, str(value))
-        return template
+class CompiledTemplate:
+    """Text template parsed once into literal and placeholder segments."""
 
-    def escape_f_string(text):
-        return text.replace('{', '{{').replace('}', '}}')
+    def __init__(self, template):
+        self.template = template
+        self.segment_list = []
 
-    replaced_text = replace_placeholders(text, input_variables)
-    escaped_text = escape_f_string(replaced_text)
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(template):
+            self.segment_list.append(
+                (template[position:match.start()], match.group(1), match.group(0)))
+            position = match.end()
+        self.tail = template[position:]
 
-    prompt = PromptTemplate.from_template("")
-    prompt.template = escaped_text
-    prompt.validate_template = False
-    valid_input_variables = {}
+        self.variables = frozenset(name for _, name, _ in self.segment_list)
 
-    return prompt, valid_input_variables
+    def render(self, input_variables=None):
+        """Render in a single pass, leaving placeholders without a variable untouched."""
+        if not input_variables or not self.segment_list:
+            return self.template
+
+        part_list = []
+        for literal, name, placeholder in self.segment_list:
+            part_list.append(literal)
+            if name in input_variables:
+                part_list.append(str(input_variables[name]))
+            else:
+                part_list.append(placeholder)
+        part_list.append(self.tail)
+
+        return "".join(part_list)
+
+
+@lru_cache(maxsize=1024)
+def compile_template(template):
+    """Compile template."""
+    return CompiledTemplate(template)
@@ -0,0 +1,75 @@
+"""Vector search benchmark.
+
+Reports recall@k and latency of indexed LanceDB searches for a range of nprobes, against exact
+nearest neighbours computed over the whole table. Query vectors are sampled from the table, so
+no embedding API calls are made.
+
+Usage: python -m core.doc_search.benchmark <db_path> <embedding_id> [--build-index]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from core.doc_search.vector_store import build_ivf_pq_index, open_table, search_table
+
+
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-locals
+def benchmark_search(table, k=3, num_queries=100, nprobes_list=(1, 5, 10, 20, 50),
+                     refine_factor=None, seed=0):
+    """Benchmark search."""
+    df = table.to_pandas()
+    vectors = np.stack(df["vector"].to_numpy())
+    ids = df["id"].to_numpy()
+
+    rng = np.random.default_rng(seed)
+    query_index_list = rng.choice(len(vectors), size=min(num_queries, len(vectors)),
+                                  replace=False)
+
+    exact_list = []
+    for query_index in query_index_list:
+        distances = np.linalg.norm(vectors - vectors[query_index], axis=1)
+        exact_list.append(set(ids[np.argsort(distances)[:k]]))
+
+    report = []
+    for nprobes in nprobes_list:
+        hits = 0
+        latency_list = []
+        for query_index, exact in zip(query_index_list, exact_list):
+            start = time.perf_counter()
+            docs = search_table(table, vectors[query_index], k=k, nprobes=nprobes,
+                                refine_factor=refine_factor)
+            latency_list.append(time.perf_counter() - start)
+            hits += len(exact & set(docs["id"]))
+
+        report.append({
+            "nprobes": nprobes,
+            "refine_factor": refine_factor,
+            "recall": hits / (k * len(exact_list)),
+            "latency_p50_ms": float(np.percentile(latency_list, 50) * 1000),
+            "latency_p95_ms": float(np.percentile(latency_list, 95) * 1000),
+        })
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", maxsplit=1)[0])
+    parser.add_argument("db_path")
+    parser.add_argument("embedding_id")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--refine-factor", type=int, default=None)
+    parser.add_argument("--build-index", action="store_true")
+    args = parser.parse_args()
+
+    lance_table = open_table(args.db_path, args.embedding_id)
+    if args.build_index:
+        build_ivf_pq_index(lance_table)
+
+    for row in benchmark_search(lance_table, k=args.k, num_queries=args.num_queries,
+                                refine_factor=args.refine_factor):
+        print(f"nprobes={row['nprobes']:>4} refine_factor={row['refine_factor']} "
+              f"recall@{args.k}={row['recall']:.3f} "
+              f"p50={row['latency_p50_ms']:.2f}ms p95={row['latency_p95_ms']:.2f}ms")
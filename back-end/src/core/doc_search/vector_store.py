@@ -1,49 +1,125 @@
 """Vector store."""
+import math
+import threading
+from collections import OrderedDict
+
 from langchain.vectorstores import LanceDB
 
 import lancedb
 
+# Opened LanceDB tables, keyed by (db_path, table_name, version), most recently used last.
+# The version changes whenever a table is rewritten, so processes other than the writer
+# never reuse a stale handle.
+TABLE_CACHE_SIZE = 64
+_table_cache = OrderedDict()
+_table_cache_lock = threading.Lock()
+
+
+def open_table(db_path, table_name, version=None):
+    """Open a LanceDB table, reusing the handle of a previous call of the same version."""
+    key = (db_path, table_name, version)
+    with _table_cache_lock:
+        if key in _table_cache:
+            _table_cache.move_to_end(key)
+            return _table_cache[key]
+
+    table = lancedb.connect(db_path).open_table(table_name)
+
+    with _table_cache_lock:
+        for stale_key in [stale_key for stale_key in _table_cache
+                          if stale_key[:2] == key[:2] and stale_key != key]:
+            del _table_cache[stale_key]
+        _table_cache[key] = table
+        _table_cache.move_to_end(key)
+        while len(_table_cache) > TABLE_CACHE_SIZE:
+            _table_cache.popitem(last=False)
+
+    return table
+
+
+def invalidate_table(table_name):
+    """Drop cached handles of a table, e.g. once it is deleted or rewritten."""
+    with _table_cache_lock:
+        for key in [key for key in _table_cache if key[1] == table_name]:
+            del _table_cache[key]
+
+
+def search_table(table, vector, k=3, nprobes=None, refine_factor=None):
+    """Search a table by vector.
+
+    On an IVF-PQ indexed table, nprobes is the number of partitions probed and refine_factor
+    re-ranks k * refine_factor candidates with exact distances. Both are ignored without index.
+    """
+    query = table.search(vector).limit(k)
+    if nprobes:
+        query = query.nprobes(nprobes)
+    if refine_factor:
+        query = query.refine_factor(refine_factor)
+    return query.to_df()
+
+
+def build_ivf_pq_index(table, num_partitions=None, num_sub_vectors=None):
+    """Build an IVF-PQ index on the vector column of a table."""
+    row_count = len(table)
+    if num_partitions is None:
+        num_partitions = max(1, min(256, int(math.sqrt(row_count))))
+    if num_sub_vectors is None:
+        # Sub-vectors of 16 dimensions, 1536 dimensional ada-002 vectors get 96
+        dimension = table.schema.field("vector").type.list_size
+        num_sub_vectors = max(1, dimension // 16)
+        while dimension % num_sub_vectors:
+            num_sub_vectors -= 1
+
+    table.create_index(metric="L2", num_partitions=num_partitions,
+                       num_sub_vectors=num_sub_vectors, replace=True)
+
 
 class VectorStoreLanceDB:
     """Vector store lance DB."""
-    def __init__(self, db_path, table_name, mode, embedding_model):
-        self.db = lancedb.connect(db_path)
+    def __init__(self, db_path, table_name, mode, embedding_model, version=None):
+        self.db_path = db_path
         self.embedding_model = embedding_model
 
-        print(db_path)
-
-        hello_world_vector = self.embedding_model.embed_text("Hello world")
-
         if mode == "read":
-            table = self.db.open_table(table_name)
-        elif mode == "overwrite":
-            # pylint: disable=unexpected-keyword-arg
-            table = self.db.create_table(name=table_name,
-                                         data=[
-                                             {
-                                                 "vector": hello_world_vector,
-                                                 "text": "Hello World",
-                                                 "id": "1"
-                                             }
-                                         ],
-                                         mode="overwrite")
+            # Read mode only needs the table, which is cached across requests. The embedding
+            # model carries the caller's API key, so it is bound per instance instead.
+            self.db = None
+            table = open_table(db_path, table_name, version)
         else:
-            table = self.db.create_table(name=table_name,
-                                         data=[
-                                             {
-                                                 "vector": hello_world_vector,
-                                                 "text": "Hello World",
-                                                 "id": "1"
-                                             }
-                                         ])
+            self.db = lancedb.connect(db_path)
+            hello_world_vector = self.embedding_model.embed_text("Hello world")
+            invalidate_table(table_name)
+
+            if mode == "overwrite":
+                # pylint: disable=unexpected-keyword-arg
+                table = self.db.create_table(name=table_name,
+                                             data=[
+                                                 {
+                                                     "vector": hello_world_vector,
+                                                     "text": "Hello World",
+                                                     "id": "1"
+                                                 }
+                                             ],
+                                             mode="overwrite")
+            else:
+                table = self.db.create_table(name=table_name,
+                                             data=[
+                                                 {
+                                                     "vector": hello_world_vector,
+                                                     "text": "Hello World",
+                                                     "id": "1"
+                                                 }
+                                             ])
 
+        self.table = table
         # pylint: disable=not-callable
         self.vec_db = LanceDB(
             connection=table, embedding=self.embedding_model.embedding_model)
 
     def drop_table(self, table_name):
         """Drop table."""
-        self.db.drop_table(table_name)
+        invalidate_table(table_name)
+        (self.db or lancedb.connect(self.db_path)).drop_table(table_name)
 
     def add_text(self, text):
         """Add text."""
@@ -61,8 +137,18 @@ class VectorStoreLanceDB:
         """Add document list."""
         self.vec_db.add_documents(doc_list)
 
-    def similarity_search(self, query, k=3):
+    def count_rows(self):
+        """Count rows."""
+        return len(self.table)
+
+    def build_index(self, num_partitions=None, num_sub_vectors=None):
+        """Build an IVF-PQ index so searches stop scanning the whole table."""
+        build_ivf_pq_index(self.table, num_partitions, num_sub_vectors)
+
+    def similarity_search(self, query, k=3, nprobes=None, refine_factor=None):
         """Similarity search."""
-        docs = self.vec_db.similarity_search(query, k=k)
-        text_list = [doc.page_content for doc in docs]
+        vector = self.embedding_model.embed_text(query)
+        docs = search_table(self.table, vector, k=k, nprobes=nprobes,
+                            refine_factor=refine_factor)
+        text_list = docs["text"].tolist()
         return text_list
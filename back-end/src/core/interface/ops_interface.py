@@ -1,8 +1,14 @@
 """Ops interface."""
 import datetime
 import copy
+import queue
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from celery import shared_task, current_task
+from celery import chord, shared_task, current_task
+from flask import current_app
+from sqlalchemy import insert
 
 from core.llm_processor.openai import OpenAIProcessor, OpenAIEmbedding
 from core.llm_processor.anthropic_processor import AnthropicProcessor
@@ -15,14 +21,25 @@ from core.component.youtube_transcript import YouTubeTranscript
 from core.component.chain import Chain
 
 from core.doc_search.doc_transformer import TextSplitter
-from core.doc_search.vector_store import VectorStoreLanceDB
+from core.doc_search.vector_store import VectorStoreLanceDB, invalidate_table
+from core.retry import call_with_retry
+from core.task_progress import EMBEDDING_TASK_PREFIX, TaskRedisRecords
 
 from connection import db
-from model.application import DbAppTask, TaskStatus
+from model.application import DbAppBuild, DbAppTask, DbAppTaskResult, TaskStatus
 from model.types import ApiType
-from model.file import DbEmbedding
+from model.file import DbEmbedding, DbFile
+from services.file_storage_service import (
+    MissingTableRowsError,
+    count_table_rows,
+    iter_table_rows,
+)
 from services.quota_service import QuotaService
-from services.user_api_key_service import get_selected_user_api_key_type_or_none
+from services.user_api_key_service import (
+    get_selected_user_api_key_type_or_none,
+    get_selected_user_api_key_type_or_public,
+    get_selected_user_llm_api_key_dict,
+)
 
 from config import logger
 
@@ -34,9 +51,9 @@ def text_convert(text_template, input_variables=None):
     return res
 
 
-def tag_parse(tag, text_template, input_variables=None):
+def tag_parse(tag, text_template, input_variables=None, occurrence=0):
     """Tag parse."""
-    parser_obj = TagParser(tag)
+    parser_obj = TagParser(tag, occurrence)
     text_obj = Text(text_template)
     res = parser_obj.parse(text_obj, input_variables)
     return res
@@ -104,6 +121,30 @@ def complete(prompt,
     return res
 
 
+def complete_stream(prompt,
+                    input_variables=None,
+                    model_provider=ApiType.OPENAI.value,
+                    params_dict=None,
+                    llm_api_key_dict=None):
+    """Complete, streaming the completion token by token."""
+    if params_dict is None:
+        params_dict = {}
+
+    if llm_api_key_dict is None:
+        llm_api_key_dict = {}
+
+    llm_processor = select_llm_processor(
+        model_provider, params_dict, llm_api_key_dict)
+    if llm_processor is None:
+        return None
+
+    prompt_obj = Prompt(llm_processor)
+    text_obj = Text(prompt)
+    text = text_obj.text_convert(input_variables)
+
+    return prompt_obj.stream(text)
+
+
 def select_doc_transformer(doc_transformer_type, params_dict):
     """Select doc transformer."""
     if doc_transformer_type == "text_splitter":
@@ -144,7 +185,9 @@ def load_vector_store(embedding_id, llm_api_key_dict):
     embedding_build = DbEmbedding.query.filter(
         DbEmbedding.id == embedding_id).first()
 
-    if embedding_build is None:
+    # The table is incomplete until the embedding task finishes
+    if embedding_build is None or embedding_build.deleted_at is not None or \
+            embedding_build.status != TaskStatus.COMPLETED.value:
         return None
 
     embedding_config = embedding_build.config
@@ -163,6 +206,8 @@ def load_vector_store(embedding_id, llm_api_key_dict):
     vector_store_params_dict["embedding_model"] = embedding_model
     vector_store_params_dict["table_name"] = embedding_id
     vector_store_params_dict["mode"] = "read"
+    # Completion time versions the cached table, re-running the embedding rewrites it
+    vector_store_params_dict["version"] = embedding_build.completed_at
     vector_store = select_vector_store(
         vector_store_provider, vector_store_params_dict)
 
@@ -172,12 +217,49 @@ def load_vector_store(embedding_id, llm_api_key_dict):
     return vector_store
 
 
+def invalidate_vector_store(embedding_id):
+    """Invalidate cached vector store handles of an embedding."""
+    invalidate_table(embedding_id)
+
+
+def adjust_action_list(action_list):
+    """Convert the actions of an application build into chain actions."""
+    index = 1
+    for action in action_list:
+        action["name"] = action["title"]
+        index += 1
+
+        if action["type"] in ApiType.values():
+            action["model_provider"] = action["type"]
+            action["type"] = "prompt"
+
+        if action["type"] == "batch-input":
+            action["type"] = "table"
+
+        if action["type"] in ("text-input", "output"):
+            action["type"] = "text"
+
+        if action["type"] == "tag-parser":
+            action["type"] = "tag_parser"
+            action["tag"] = action["parameters"]["extract_pattern"]
+            action["occurrence"] = action["parameters"].get("occurrence", 0)
+
+        if action["type"] == "google-search":
+            action["type"] = "google_search"
+            action["num_results"] = action["parameters"]["num_results"]
+
+        if action["type"] == "doc-search":
+            action["type"] = "doc_search"
+
+    return action_list
+
+
 def load_chain(action_list, llm_api_key_dict=None):
     """Load chain."""
     if llm_api_key_dict is None:
         return None
 
-    chain_obj = Chain()
+    chain_obj = Chain(max_workers=current_app.config.get("CHAIN_MAX_WORKERS", 4))
 
     for action in action_list:
         # if action["type"] == "table":
@@ -201,7 +283,7 @@ def load_chain(action_list, llm_api_key_dict=None):
             chain_obj.add_prompt(prompt_obj, text_obj, action["name"],
                                  action["is_app_input"], action["is_app_output"])
         elif action["type"] == "tag_parser":
-            parser_obj = TagParser(action["tag"])
+            parser_obj = TagParser(action["tag"], action.get("occurrence", 0))
             text_obj = Text(action["input"])
 
             chain_obj.add_parser(parser_obj, text_obj,
@@ -233,7 +315,9 @@ def load_chain(action_list, llm_api_key_dict=None):
 
             top_n = params_dict.get("top_n", 3)
             doc_search_obj = DocSearch(
-                vector_store, action["input"], top_n)
+                vector_store, action["input"], top_n,
+                nprobes=params_dict.get("nprobes", None),
+                refine_factor=params_dict.get("refine_factor", None))
             chain_obj.add_doc_search(
                 doc_search_obj, action["name"],
                 action["is_app_input"], action["is_app_output"])
@@ -253,21 +337,242 @@ def run_chain(action_list, input_variables=None, llm_api_key_dict=None):
     return res
 
 
+def run_chain_stream(action_list, input_variables=None, llm_api_key_dict=None):
+    """Run chain, streaming (event, data) pairs and ending with ("result", ...) or ("error", ...)."""
+    chain_obj = load_chain(action_list, llm_api_key_dict=llm_api_key_dict)
+
+    if chain_obj is None:
+        return None
+
+    return _stream_chain(chain_obj, input_variables)
+
+
+def _stream_chain(chain_obj, input_variables):
+    """Run the chain in a background thread and relay its events."""
+    events = queue.Queue()
+
+    def run():
+        try:
+            res = chain_obj.run(input_variables,
+                                callback=lambda event, data: events.put((event, data)))
+            events.put(("result", res))
+        except Exception as e:
+            events.put(("error", str(e)))
+
+    threading.Thread(target=run, daemon=True).start()
+
+    while True:
+        event, data = events.get()
+        yield event, data
+        if event in ("result", "error"):
+            break
+
+
 class InsufficientQuotaException(Exception):
     """InsufficientQuotaException."""
 
 
+def _resolve_batch_concurrency(concurrency):
+    """Clamp the requested row concurrency to the per-task ceiling."""
+    max_concurrency = current_app.config.get("BATCH_TASK_MAX_CONCURRENCY", 1)
+    try:
+        concurrency = int(concurrency)
+    except (TypeError, ValueError):
+        concurrency = 1
+    return max(1, min(concurrency, max_concurrency))
+
+
+# Shared by every batch task and chunk of the process, created on first use from the config
+_process_row_semaphore = None
+_process_row_semaphore_lock = threading.Lock()
+
+
+def _get_process_row_semaphore():
+    """Semaphore bounding the batch rows running at once in this process."""
+    global _process_row_semaphore  # pylint: disable=global-statement
+    with _process_row_semaphore_lock:
+        if _process_row_semaphore is None:
+            _process_row_semaphore = threading.BoundedSemaphore(
+                max(1, current_app.config.get("BATCH_PROCESS_MAX_CONCURRENT_ROWS", 8)))
+        return _process_row_semaphore
+
+
+def _row_retry_config():
+    return {
+        "max_retries": current_app.config.get("BATCH_ROW_MAX_RETRIES", 3),
+        "base_delay": current_app.config.get("BATCH_ROW_RETRY_BASE_DELAY_SEC", 2),
+        "max_delay": current_app.config.get("BATCH_ROW_RETRY_MAX_DELAY_SEC", 60),
+    }
+
+
+def _run_table_rows(chain_obj, input_variables, table_rows, concurrency=1):
+    """Run table rows.
+
+    Rows run on a bounded pool, their quota is reserved for the whole task when it starts.
+    Each row retries transient errors with backoff on its own, (result, None) is yielded for
+    every row in input order, or (None, error message) when the row failed for good.
+
+    Rows finishing ahead of an earlier one wait in a reorder buffer while the pool moves on
+    to the next rows, so a slow row, backing off from a rate limit say, holds up the order of
+    the results but not the other workers. Running and buffered rows are bounded by a window
+    of BATCH_TASK_ROW_WINDOW_FACTOR times the concurrency. Closing the generator early drops
+    the rows that have not started, only the running ones are waited for.
+
+    Each attempt of a row also holds a slot of the process-wide row semaphore, so concurrent
+    tasks of one worker process share BATCH_PROCESS_MAX_CONCURRENT_ROWS. Rows backing off
+    from a retry do not hold a slot.
+    """
+    retry_config = _row_retry_config()
+    row_semaphore = _get_process_row_semaphore()
+    window = concurrency * max(1, current_app.config.get("BATCH_TASK_ROW_WINDOW_FACTOR", 4))
+    row_iter = iter(table_rows)
+    running = {}
+    finished = {}
+    submit_index = 0
+    yield_index = 0
+
+    def run_row_attempt(row_input_variables):
+        with row_semaphore:
+            return chain_obj.run(row_input_variables)
+
+    def run_row(row_input_variables):
+        return call_with_retry(lambda: run_row_attempt(row_input_variables), **retry_config)
+
+    def row_outcome(future):
+        try:
+            return future.result(), None
+        except Exception as e:
+            return None, str(e) or type(e).__name__
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            while True:
+                while submit_index - yield_index < window:
+                    table = next(row_iter, None)
+                    if table is None:
+                        break
+                    current_input_variables = copy.deepcopy(input_variables or {})
+                    current_input_variables.update(table)
+                    running[executor.submit(run_row, current_input_variables)] = submit_index
+                    submit_index += 1
+
+                if not running:
+                    return
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished[running.pop(future)] = row_outcome(future)
+                while yield_index in finished:
+                    yield finished.pop(yield_index)
+                    yield_index += 1
+        finally:
+            for future in running:
+                future.cancel()
+
+
+FAILED_ROW_ERROR_KEY = "error"
+
+
+def _failed_row_result(chain_obj, error):
+    """Result stored in place of a failed row, with the outputs of a row that succeeded."""
+    res = dict.fromkeys(chain_obj.output_names())
+    res[FAILED_ROW_ERROR_KEY] = error
+    return res
+
+
+def result_column_list(task_build, sample_res):
+    """Columns of the results of a batch task, from a sample row.
+
+    The error column of failed rows is added when any row failed, wherever the first of them
+    is.
+    """
+    column_list = list(sample_res.keys())
+    progress = load_task_progress(task_build) or {}
+    if progress.get("failed") and FAILED_ROW_ERROR_KEY not in column_list:
+        column_list.append(FAILED_ROW_ERROR_KEY)
+    return column_list
+
+
+def _batch_progress(total, completed, failed):
+    """Progress in the format of TaskRedisRecords.get_progress."""
+    progress = {"total": total, "completed": completed}
+    if failed:
+        progress["failed"] = failed
+    return progress
+
+
+def _load_app_action_list(app_id):
+    """Load the chain actions of an application."""
+    app_build = DbAppBuild.query.filter(
+        DbAppBuild.id == app_id,
+        DbAppBuild.deleted_at.is_(None)).first()
+    if app_build is None:
+        raise ValueError("application not found")
+
+    return adjust_action_list(copy.deepcopy(app_build.chain))
+
+
+def _load_batch_app(task_id, created_by):
+    """Load the chain actions a batch task was started with and the API keys of its owner.
+
+    Every chunk runs the same actions, the ones the quota was reserved for, even when the
+    application is edited while the task runs.
+    """
+    action_list = TaskRedisRecords(task_id, total=-1).get_app_action_list()
+    if action_list is None:
+        raise ValueError("application snapshot not found")
+
+    return action_list, get_selected_user_llm_api_key_dict(created_by)
+
+
+def close_batch_task(task_build, status, message=None):
+    """End a batch task that did not complete, keeping the rows it has done so far.
+
+    Rows of a non-distributed task are only in Redis until it completes, they are saved to
+    t_task_result with the final progress before the records are dropped. The quota of the
+    rows not done is refunded. Chunks of a distributed task may still be running a row, so
+    the chord callback settles it once they have all stopped. Tasks that have already
+    finished are left as they are.
+    """
+    if task_build.status not in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value):
+        return
+
+    distributed = (task_build.result or {}).get("distributed", False)
+    progress_records = TaskRedisRecords(task_build.id, total=-1)
+    _save_task_results(task_build.id, progress_records.get_task_result())
+    progress = progress_records.get_progress()
+    if progress is not None:
+        task_build.result = {"progress": progress, "distributed": distributed}
+    task_build.status = status.value
+    if message is not None:
+        task_build.message = {"message": message}
+    task_build.completed_at = datetime.datetime.utcnow()
+    db.session.commit()
+    if not distributed:
+        QuotaService.settle_user_quota(task_build.id, progress_records.get_task_progress())
+    progress_records.deactivate(status.name)
+
+
+def _fail_batch_task(task_build, message):
+    """Mark a batch task as failed."""
+    close_batch_task(task_build, TaskStatus.FAILED, message)
+
+
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-locals
 @shared_task(ignore_result=True)
-def batch_task(action_list, input_variables, table_list, task_name, created_by, created_at,
-               app_id, file_id,
-               llm_api_key_dict=None):
-    """Batch task."""
+def batch_task(task_name, created_by, created_at, app_id, file_id, input_variables=None,
+               concurrency=1, distributed=False, chunk_size=None):
+    """Batch task.
+
+    Only references go through the broker, the application, the table rows and the API keys
+    of the owner are loaded here.
+    """
     task_id = current_task.request.id
-    total = len(table_list)
+    concurrency = _resolve_batch_concurrency(concurrency)
     res_list = []
     count = 0
+    failed_count = 0
 
     task_build = DbAppTask(id=task_id, task_name=task_name, created_by=created_by,
                            created_at=created_at, app_id=app_id, file_id=file_id, published=False)
@@ -275,94 +580,339 @@ def batch_task(action_list, input_variables, table_list, task_name, created_by,
     db.session.add(task_build)
     db.session.commit()
 
+    file_data = DbFile.query.get(file_id)
+    if file_data is None:
+        _fail_batch_task(task_build, "file not found")
+        return
+    try:
+        total = count_table_rows(file_data)
+    except MissingTableRowsError as e:
+        _fail_batch_task(task_build, str(e))
+        return
+
     try:
+        action_list, llm_api_key_dict = _load_batch_app(task_id, created_by)
         chain_obj = load_chain(action_list, llm_api_key_dict=llm_api_key_dict)
     except Exception as e:
-        task_build.status = TaskStatus.FAILED.value
-        task_build.message = {"message": "application load failure. " + str(e)}
-        task_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_batch_task(task_build, "application load failure. " + str(e))
         return
 
     if chain_obj is None:
-        task_build.status = TaskStatus.FAILED.value
-        task_build.message = {"message": "application load failure"}
-        task_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_batch_task(task_build, "application load failure")
         return
 
-    try:
-        for table in table_list:
+    progress_records = TaskRedisRecords(task_id, total)
 
-            quota_needed = QuotaService.calculate_app_quota(
-                created_by, action_list)
-            current_quota = QuotaService.check_user_quota(created_by)
+    if distributed:
+        _dispatch_batch_chunks(task_build, input_variables, total, concurrency, chunk_size)
+        return
 
-            if current_quota.get('quota_available') < quota_needed:
-                raise InsufficientQuotaException(
-                    f"Insufficient quota: required {quota_needed}, " +
-                    f"available {current_quota.get('quota_available')}")
+    # Progress and row results go to Redis as they are produced, the DB is only written
+    # once more when the task completes
+    task_build.status = TaskStatus.RUNNING.value
+    task_build.result = {"progress": {"total": total, "completed": 0}}
+    db.session.commit()
 
-            current_input_variables = copy.deepcopy(input_variables)
-            current_input_variables.update(table)
-            res = chain_obj.run(current_input_variables)
+    try:
+        # A failed row does not fail the task, it is recorded and the next rows go on
+        for row_index, (res, error) in enumerate(_run_table_rows(
+                chain_obj, input_variables, iter_table_rows(file_data), concurrency)):
+            # Stopped or failed meanwhile, the rows done so far are saved and settled already
+            if progress_records.is_finished():
+                return
+            if error is None:
+                count += 1
+                progress_records.append_result(res)
+            else:
+                failed_count += 1
+                res = _failed_row_result(chain_obj, error)
+                progress_records.append_failed_row(res, f"row {row_index}: {error}")
             res_list.append(res)
-            count += 1
-
-            task_build.status = TaskStatus.RUNNING.value
-            task_build.result = {
-                "progress": {"total": total, "completed": count},
-                "result": res_list
-            }
-            db.session.commit()
-            current_task.update_state(state="RUNNING",
-                                      meta={"progress": {"total": total, "completed": count}})
 
-            QuotaService.update_user_quota(created_by, quota_needed)
+            current_task.update_state(state="RUNNING", meta={
+                "progress": _batch_progress(total, count, failed_count)})
 
         if task_build is None:
             return
 
+        _save_task_results(task_id, res_list)
         task_build.status = TaskStatus.COMPLETED.value
         task_build.completed_at = datetime.datetime.utcnow()
-        task_build.result = {"progress": {"total": total,
-                                          "completed": count}, "result": res_list}
+        if failed_count:
+            task_build.message = {"message": f"{failed_count} of {total} rows failed"}
+        task_build.result = {"progress": _batch_progress(total, count, failed_count),
+                             "result": res_list}
         db.session.commit()
+        QuotaService.settle_user_quota(task_id, count)
+        progress_records.deactivate(TaskStatus.COMPLETED.name)
     except Exception as e:
         db.session.rollback()
-        task_build.status = TaskStatus.FAILED.value
+        _fail_batch_task(task_build, str(e))
+        return {"error": str(e)}
 
-        if isinstance(e, InsufficientQuotaException):
-            task_build.message = {"message": str(e)}
-        else:
-            task_build.message = {"message": str(e)}
 
-        task_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
-        return {"error": str(e)}
+def _save_task_results(task_id, res_list, offset=0):
+    """Insert row results into t_task_result, a bounded number of rows per statement."""
+    insert_size = current_app.config.get("TASK_RESULT_INSERT_SIZE", 500)
+    for start in range(0, len(res_list), insert_size):
+        db.session.execute(insert(DbAppTaskResult), [
+            {"task_id": task_id, "row_index": offset + index, "result": res}
+            for index, res in enumerate(res_list[start:start + insert_size], start)
+        ])
+
+
+def load_task_results(task_id, offset=0, limit=None):
+    """Load (row_index, result) pairs of task results persisted row by row, in row order.
 
+    Rows of unfinished or failed chunks are missing, so row_index may skip values.
+    """
+    query = (db.session.query(DbAppTaskResult.row_index, DbAppTaskResult.result)
+             .filter(DbAppTaskResult.task_id == task_id)
+             .order_by(DbAppTaskResult.row_index)
+             .offset(offset))
+    if limit is not None:
+        query = query.limit(limit)
+    return [(row.row_index, row.result) for row in query]
 
-def start_batch_task(action_list, input_variables, table_list, task_name, created_by, created_at,
-                     app_id, file_id,
-                     llm_api_key_dict=None):
-    """Start batch task."""
-    task = batch_task.delay(action_list, input_variables, table_list, task_name,
-                            created_by, created_at, app_id, file_id,
-                            llm_api_key_dict=llm_api_key_dict)
+
+def _is_task_unfinished(task_build):
+    return task_build.status in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value)
+
+
+def load_task_progress(task_build):
+    """Load the progress of a batch task without loading its row results."""
+    if _is_task_unfinished(task_build):
+        progress = TaskRedisRecords(task_build.id, total=-1).get_progress()
+        if progress is not None:
+            return progress
+
+    return db.session.query(DbAppTask.result["progress"]).filter(
+        DbAppTask.id == task_build.id).scalar()
+
+
+def load_task_progress_dict(task_build_list):
+    """Load the progress of several batch tasks at once, keyed by task id."""
+    progress_dict = TaskRedisRecords.get_progress_dict(
+        [t.id for t in task_build_list if _is_task_unfinished(t)])
+
+    stored_task_id_list = [t.id for t in task_build_list if progress_dict.get(t.id) is None]
+    if stored_task_id_list:
+        progress_dict.update(db.session.query(DbAppTask.id, DbAppTask.result["progress"]).filter(
+            DbAppTask.id.in_(stored_task_id_list)).all())
+    return progress_dict
+
+
+def load_task_result_page(task_build, offset=0, limit=None):
+    """Load a page of (row_index, result) pairs of a batch task, wherever they are kept by now.
+
+    Rows of a running task are in Redis, or in t_task_result for completed chunks of a
+    distributed task. Finished tasks have their rows in t_task_result, except for tasks that
+    finished before it existed, whose rows are only in the result column. Redis and the
+    result column keep every row in order, so their position is the row index.
+    """
+    if limit is not None and limit <= 0:
+        return []
+
+    if _is_task_unfinished(task_build):
+        end = -1 if limit is None else offset + limit - 1
+        result_list = TaskRedisRecords(task_build.id, total=-1).get_task_result(offset, end)
+        if result_list:
+            return list(enumerate(result_list, offset))
+
+    result_list = load_task_results(task_build.id, offset, limit)
+    if result_list:
+        return result_list
+
+    has_result_rows = db.session.query(DbAppTaskResult.id).filter(
+        DbAppTaskResult.task_id == task_build.id).first() is not None
+    if has_result_rows:
+        return []
+
+    legacy_result_list = db.session.query(DbAppTask.result["result"]).filter(
+        DbAppTask.id == task_build.id).scalar() or []
+    return list(enumerate(legacy_result_list[offset:None if limit is None else offset + limit],
+                          offset))
+
+
+# pylint: disable=too-many-arguments
+def _dispatch_batch_chunks(task_build, input_variables, total, concurrency, chunk_size):
+    """Split the table into row ranges run as subtasks, merged by a chord callback."""
+    if chunk_size is None:
+        chunk_size = current_app.config.get("BATCH_TASK_CHUNK_SIZE", 100)
+    chunk_size = max(1, int(chunk_size))
+
+    task_build.status = TaskStatus.RUNNING.value
+    task_build.result = {"progress": {"total": total, "completed": 0}, "distributed": True}
+    db.session.commit()
+
+    header = [
+        batch_chunk_task.s(task_build.id, offset, chunk_size, input_variables,
+                           concurrency=concurrency)
+        for offset in range(0, total, chunk_size)
+    ]
+    chord(header)(batch_chunk_callback.s(task_build.id))
+
+
+def _is_batch_task_active(task_id):
+    """Whether a batch task has not been stopped or failed."""
+    status = db.session.query(DbAppTask.status).filter(DbAppTask.id == task_id).scalar()
+    return status in (TaskStatus.QUEUED.value, TaskStatus.RUNNING.value)
+
+
+# pylint: disable=too-many-arguments
+@shared_task(bind=True, max_retries=3, default_retry_delay=10)
+def batch_chunk_task(self, task_id, offset, limit, input_variables, concurrency=1):
+    """Batch chunk task, running rows [offset, offset + limit) of the task file.
+
+    Returns the number of rows done, which the chord callback settles. The chunk stops at
+    the next row once the task is stopped or failed, and a chunk failing for good fails the
+    task without raising, so that the callback still runs after the other chunks.
+    """
+    if not _is_batch_task_active(task_id):
+        return 0
+
+    task_build = DbAppTask.query.get(task_id)
+    progress_records = TaskRedisRecords(task_id, total=-1)
+    try:
+        action_list, llm_api_key_dict = _load_batch_app(task_id, task_build.created_by)
+        chain_obj = load_chain(action_list, llm_api_key_dict=llm_api_key_dict)
+        if chain_obj is None:
+            raise ValueError("application load failure")
+
+        table_rows = iter_table_rows(DbFile.query.get(task_build.file_id), offset, limit)
+        res_list = []
+        fail_message_list = []
+        for row_index, (res, error) in enumerate(
+                _run_table_rows(chain_obj, input_variables, table_rows, concurrency), offset):
+            if progress_records.is_finished():
+                break
+            if error is not None:
+                res = _failed_row_result(chain_obj, error)
+                fail_message_list.append(f"row {row_index}: {error}")
+            res_list.append(res)
+    except Exception as e:
+        db.session.rollback()
+        if self.request.retries >= self.max_retries:
+            logger.error(f"batch chunk failure. task {task_id}, offset {offset}: {e}")
+            _fail_batch_task(DbAppTask.query.get(task_id), str(e))
+            return 0
+        raise self.retry(exc=e)
+
+    _save_task_results(task_id, res_list, offset)
+    db.session.commit()
+
+    # Failed rows are only recorded once the chunk is saved, so that a retried chunk does not
+    # record them twice
+    for fail_message in fail_message_list:
+        progress_records.append_fail_message(fail_message)
+    completed_count = len(res_list) - len(fail_message_list)
+    progress_records.increase_task_progress(completed_count)
+
+    return completed_count
+
+
+@shared_task(ignore_result=True)
+def batch_chunk_callback(chunk_count_list, task_id):
+    """Materialize the rows written by the chunks into the batch task and settle its quota.
+
+    Every chunk has stopped by now, a task stopped or failed meanwhile only gets its final
+    progress and is settled.
+    """
+    task_build = DbAppTask.query.get(task_id)
+    if task_build is None:
+        return
+
+    progress_records = TaskRedisRecords(task_id, total=-1)
+    if task_build.status != TaskStatus.RUNNING.value:
+        progress = progress_records.get_progress()
+        if progress is not None:
+            task_build.result = {"progress": progress, "distributed": True}
+            db.session.commit()
+        QuotaService.settle_user_quota(task_id, sum(chunk_count_list))
+        return
+
+    res_list = [res for _, res in load_task_results(task_id)]
+    failed_count = progress_records.get_task_fail()
+    task_build.status = TaskStatus.COMPLETED.value
+    task_build.completed_at = datetime.datetime.utcnow()
+    if failed_count:
+        task_build.message = {"message": f"{failed_count} of {len(res_list)} rows failed"}
+    task_build.result = {
+        "progress": _batch_progress(len(res_list), sum(chunk_count_list), failed_count),
+        "result": res_list, "distributed": True}
+    db.session.commit()
+    QuotaService.settle_user_quota(task_id, sum(chunk_count_list))
+    progress_records.deactivate(TaskStatus.COMPLETED.name)
+
+
+# pylint: disable=too-many-arguments
+def start_batch_task(task_name, created_by, created_at, app_id, file_id, input_variables=None,
+                     concurrency=1, distributed=False, chunk_size=None, row_count=0):
+    """Start batch task.
+
+    The quota of all row_count rows is reserved before the task is queued, raising
+    InsufficientQuotaException right away when the owner does not have it. The chain actions
+    it is reserved for are kept with the task records, for the workers to run.
+    """
+    task_id = str(uuid.uuid4())
+    action_list = _load_app_action_list(app_id)
+    quota_per_row = QuotaService.calculate_app_quota(created_by, action_list)
+    quota_needed = quota_per_row * row_count
+    if not QuotaService.reserve_user_quota(task_id, created_by, quota_needed, quota_per_row):
+        raise InsufficientQuotaException(
+            f"Insufficient quota: required {quota_needed}, " +
+            f"available {QuotaService.check_user_quota(created_by).get('quota_available')}")
+    TaskRedisRecords(task_id, total=-1).set_app_action_list(action_list)
+
+    try:
+        task = batch_task.apply_async(
+            (task_name, created_by, created_at, app_id, file_id),
+            {"input_variables": input_variables, "concurrency": concurrency,
+             "distributed": distributed, "chunk_size": chunk_size},
+            task_id=task_id)
+    except Exception:
+        QuotaService.settle_user_quota(task_id, 0)
+        raise
 
     if task:
         return task.id
 
+    QuotaService.settle_user_quota(task_id, 0)
     return None
 
 
+def _fail_embedding_task(embedding_build, message):
+    """Mark an embedding task as failed, refunding the quota of the chunks not embedded."""
+    embedding_build.status = TaskStatus.FAILED.value
+    embedding_build.message = {"message": message}
+    embedding_build.completed_at = datetime.datetime.utcnow()
+    db.session.commit()
+    progress_records = TaskRedisRecords(embedding_build.id, total=-1,
+                                        prefix=EMBEDDING_TASK_PREFIX)
+    QuotaService.settle_user_quota(embedding_build.id, progress_records.get_task_progress())
+    progress_records.deactivate(TaskStatus.FAILED.name)
+
+
 @shared_task(ignore_result=True)
-def embedding_task(doc_transformer_type, doc_transformer_params_dict, embedding_model_provider,
-                   embedding_model_params_dict, vector_store_provider, vector_store_params_dict,
-                   text, embedding_name, created_by, file_id, llm_api_key_dict, embedding_config):
-    """Embedding task."""
+def embedding_task(embedding_config, embedding_name, created_by, file_id):
+    """Embedding task.
+
+    Only the embedding config and references go through the broker, the document text and
+    the API key of the owner are loaded here.
+    """
     embedding_id = current_task.request.id
 
+    doc_transformer_type = embedding_config["doc_transformer"]["type"]
+    doc_transformer_params_dict = embedding_config["doc_transformer"]["parameters"]
+    embedding_model_provider = embedding_config["embedding_model"]["model_provider"]
+    embedding_model_params_dict = embedding_config["embedding_model"]["parameters"]
+    vector_store_provider = embedding_config["vector_store"]["vector_store_provider"]
+    embedding_config["vector_store"]["parameters"]["db_path"] = \
+        current_app.config["VECTOR_STORE"]["db_path"]
+    vector_store_params_dict = dict(embedding_config["vector_store"]["parameters"])
+    llm_api_key_dict = {
+        "openai_api_key": get_selected_user_api_key_type_or_public("openai", created_by)}
+
     embedding_build = DbEmbedding(id=embedding_id, embedding_name=embedding_name,
                                   created_by=created_by,
                                   file_id=file_id, config=embedding_config, published=False)
@@ -374,36 +924,22 @@ def embedding_task(doc_transformer_type, doc_transformer_params_dict, embedding_
         doc_transformer = select_doc_transformer(
             doc_transformer_type, doc_transformer_params_dict)
     except Exception as e:
-        embedding_build.status = TaskStatus.FAILED.value
-        embedding_build.message = {
-            "message": "doc_transformer load failure. " + str(e)}
-        embedding_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_embedding_task(embedding_build, "doc_transformer load failure. " + str(e))
         return
 
     if doc_transformer is None:
-        embedding_build.status = TaskStatus.FAILED.value
-        embedding_build.message = {"message": "doc_transformer load failure"}
-        embedding_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_embedding_task(embedding_build, "doc_transformer load failure")
         return
 
     try:
         embedding_model = select_embedding_model(
             embedding_model_provider, embedding_model_params_dict, llm_api_key_dict)
     except Exception as e:
-        embedding_build.status = TaskStatus.FAILED.value
-        embedding_build.message = {
-            "message": "embedding_model load failure. " + str(e)}
-        embedding_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_embedding_task(embedding_build, "embedding_model load failure. " + str(e))
         return
 
     if embedding_model is None:
-        embedding_build.status = TaskStatus.FAILED.value
-        embedding_build.message = {"message": "embedding_model load failure"}
-        embedding_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_embedding_task(embedding_build, "embedding_model load failure")
         return
     try:
         vector_store_params_dict["embedding_model"] = embedding_model
@@ -411,18 +947,17 @@ def embedding_task(doc_transformer_type, doc_transformer_params_dict, embedding_
         vector_store = select_vector_store(
             vector_store_provider, vector_store_params_dict)
     except Exception as e:
-        embedding_build.status = TaskStatus.FAILED.value
-        embedding_build.message = {
-            "message": "vector_store load failure. " + str(e)}
-        embedding_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_embedding_task(embedding_build, "vector_store load failure. " + str(e))
         return
 
     if vector_store is None:
-        embedding_build.status = TaskStatus.FAILED.value
-        embedding_build.message = {"message": "vector_store load failure"}
-        embedding_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_embedding_task(embedding_build, "vector_store load failure")
+        return
+
+    file_data = DbFile.query.get(file_id)
+    text = file_data.content.get("text", None) if file_data and file_data.content else None
+    if not text:
+        _fail_embedding_task(embedding_build, "file is empty")
         return
 
     chunk_list = doc_transformer.split_text(text)
@@ -430,67 +965,72 @@ def embedding_task(doc_transformer_type, doc_transformer_params_dict, embedding_
     total = len(chunk_list)
     count = 0
 
-    is_first_or_hundredth_iteration = (count % 100 == 0 or count == 1)
-    is_openai_api_key_not_provided = (
-        get_selected_user_api_key_type_or_none("openai", created_by) is None)
-
-    try:
-        for chunk in chunk_list:
-            vector_store.add_text(chunk)
-            count += 1
-
-            if is_first_or_hundredth_iteration and is_openai_api_key_not_provided:
-                quota_needed = 1
-            else:
-                quota_needed = 0
+    # Each batch is embedded and appended to the vector store with a single add_texts call,
+    # the embedding model further splits it into requests of its own chunk_size
+    batch_size = current_app.config.get("EMBEDDING_BATCH_SIZE", 100)
+
+    # The chunk count is only known once the text is split, the quota of all of them is
+    # reserved before any is embedded
+    quota_per_chunk = 1 if get_selected_user_api_key_type_or_none("openai", created_by) is None \
+        else 0
+    quota_needed = quota_per_chunk * total
+    if not QuotaService.reserve_user_quota(embedding_id, created_by, quota_needed,
+                                           quota_per_chunk):
+        _fail_embedding_task(
+            embedding_build,
+            f"Insufficient quota: required {quota_needed}, " +
+            f"available {QuotaService.check_user_quota(created_by).get('quota_available')}")
+        return
 
-            current_quota = QuotaService.check_user_quota(created_by)
+    progress_records = TaskRedisRecords(embedding_id, total, prefix=EMBEDDING_TASK_PREFIX)
+    embedding_build.status = TaskStatus.RUNNING.value
+    embedding_build.result = {"progress": {"total": total, "completed": 0}}
+    db.session.commit()
 
-            if current_quota.get('quota_available') < quota_needed:
-                raise InsufficientQuotaException(
-                    f"Insufficient quota: required {quota_needed}, " +
-                    f"available {current_quota.get('quota_available')}")
+    try:
+        for offset in range(0, total, batch_size):
+            batch = chunk_list[offset:offset + batch_size]
+            vector_store.add_text_list(batch)
+            count += len(batch)
 
-            embedding_build.status = TaskStatus.RUNNING.value
-            embedding_build.result = {"progress": {
-                "total": total, "completed": count}}
-            db.session.commit()
+            progress_records.increase_task_progress(len(batch))
             current_task.update_state(state="RUNNING",
                                       meta={"progress": {"total": total, "completed": count}})
 
-            QuotaService.update_user_quota(created_by, quota_needed)
-
         if embedding_build is None:
             return
 
+        # Indexed before completion, readers open the table once it is COMPLETED
+        _build_vector_index(vector_store)
+
         embedding_build.status = TaskStatus.COMPLETED.value
         embedding_build.completed_at = datetime.datetime.utcnow()
         embedding_build.result = {"progress": {"total": total,
                                                "completed": count}}
         db.session.commit()
+        QuotaService.settle_user_quota(embedding_id, count)
+        progress_records.deactivate(TaskStatus.COMPLETED.name)
     except Exception as e:
         db.session.rollback()
-        embedding_build.status = TaskStatus.FAILED.value
-        if isinstance(e, InsufficientQuotaException):
-            embedding_build.message = {"message": str(e)}
-        else:
-            embedding_build.message = {"message": e}
-        embedding_build.completed_at = datetime.datetime.utcnow()
-        db.session.commit()
+        _fail_embedding_task(embedding_build, str(e))
+
+
+def _build_vector_index(vector_store):
+    """Build an ANN index once the table is large enough for brute force to hurt."""
+    threshold = current_app.config["VECTOR_STORE"].get("index_row_threshold")
+    if threshold is None:
+        return
+
+    try:
+        if vector_store.count_rows() >= threshold:
+            vector_store.build_index()
+    except Exception as e:
+        logger.warning(f"vector index build failure. {e}")
 
 
-def start_embedding_task(doc_transformer_type, doc_transformer_params_dict,
-                         embedding_model_provider,
-                         embedding_model_params_dict, vector_store_provider,
-                         vector_store_params_dict, text,
-                         embedding_name, created_by, file_id, llm_api_key_dict, embedding_config):
+def start_embedding_task(embedding_config, embedding_name, created_by, file_id):
     """Start embedding task."""
-    task = embedding_task.delay(doc_transformer_type, doc_transformer_params_dict,
-                                embedding_model_provider,
-                                embedding_model_params_dict, vector_store_provider,
-                                vector_store_params_dict, text,
-                                embedding_name, created_by, file_id,
-                                llm_api_key_dict, embedding_config)
+    task = embedding_task.delay(embedding_config, embedding_name, created_by, file_id)
 
     if task:
         return task.id
@@ -507,7 +1047,9 @@ def doc_search(embedding_id, text_template, params_dict, llm_api_key_dict, input
 
     top_n = params_dict.get("top_n", 3)
 
-    doc_search_obj = DocSearch(vector_store, text_template, top_n)
+    doc_search_obj = DocSearch(vector_store, text_template, top_n,
+                               nprobes=params_dict.get("nprobes", None),
+                               refine_factor=params_dict.get("refine_factor", None))
 
     res = doc_search_obj.search(input_variables=input_variables)
 
@@ -33,6 +33,14 @@ class AnthropicProcessor:
             "result": response.content,
         }
 
+    async def astream(self, text):
+        """Stream the completion token by token."""
+        messages = [
+            HumanMessage(content=text),
+        ]
+        async for chunk in self.llm.astream(messages):
+            yield chunk.content
+
     @staticmethod
     def check_params_dict(params_dict):
         valid_key_set = set(AnthropicProcessor.__init__.__code__.co_varnames)
@@ -0,0 +1,87 @@
+"""Embedding cache."""
+import hashlib
+import json
+import threading
+from array import array
+from collections import OrderedDict
+
+from redis.exceptions import RedisError
+
+from config import logger
+from connection import r
+
+
+class EmbeddingCache:
+    """Bounded LRU cache of text embeddings, optionally shared through Redis.
+
+    Vectors are kept as packed float32, about 6 KB for 1536 dimensions against about 49 KB
+    as a list of floats, and handed out as lists.
+    """
+
+    def __init__(self, max_size=4096, redis_client=None, ttl=None,
+                 namespace="embedding-cache:f32"):
+        self.max_size = max_size
+        self.redis = redis_client
+        self.ttl = ttl
+        self.namespace = namespace
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, model_params, text):
+        """Cache key of a text embedded by a model with the given parameters."""
+        raw_key = json.dumps(model_params, sort_keys=True) + "\0" + text
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Get a cached vector, or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key].tolist()
+
+        if self.redis is None:
+            return None
+
+        try:
+            value = self.redis.get(f"{self.namespace}:{key}")
+        except RedisError as e:
+            logger.warning(f"Embedding cache lookup failed: {e}")
+            return None
+
+        if value is None:
+            return None
+
+        packed_vector = array("f")
+        packed_vector.frombytes(value)
+        self._remember(key, packed_vector)
+        return packed_vector.tolist()
+
+    def set(self, key, vector):
+        """Cache a vector."""
+        packed_vector = array("f", vector)
+        self._remember(key, packed_vector)
+
+        if self.redis is None:
+            return
+
+        try:
+            self.redis.set(f"{self.namespace}:{key}", packed_vector.tobytes(), ex=self.ttl)
+        except RedisError as e:
+            logger.warning(f"Embedding cache update failed: {e}")
+
+    def _remember(self, key, packed_vector):
+        with self._lock:
+            self._entries[key] = packed_vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+query_embedding_cache = EmbeddingCache()
+
+
+def configure_query_embedding_cache(cache_config):
+    """Configure the process-wide query embedding cache."""
+    query_embedding_cache.max_size = cache_config.get("max_size", 4096)
+    query_embedding_cache.redis = r if cache_config.get("redis", False) else None
+    query_embedding_cache.ttl = cache_config.get("ttl")
@@ -0,0 +1,100 @@
+"""LLM cache."""
+import hashlib
+import json
+import os
+import time
+
+from langchain.cache import BaseCache, SQLiteCache
+from langchain.load.dump import dumps
+from langchain.load.load import loads
+from redis.exceptions import RedisError
+
+from config import logger
+from connection import r
+
+
+class RedisLLMCache(BaseCache):
+    """LLM cache shared by the API server and Celery workers through Redis.
+
+    Entries are keyed on the LLM string (provider, model and parameters) and the prompt. They
+    expire after `ttl` seconds, and the least recently used ones are evicted once the cache
+    holds more than `max_entries`.
+    """
+
+    def __init__(self, redis_client, ttl=None, max_entries=None, namespace="llm-cache"):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self.index_name = f"{namespace}:index"
+
+    def _key(self, prompt, llm_string):
+        digest = hashlib.sha256(f"{llm_string}\0{prompt}".encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    def lookup(self, prompt, llm_string):
+        """Look up."""
+        key = self._key(prompt, llm_string)
+        try:
+            value = self.redis.get(key)
+            if value is None:
+                return None
+            if self.max_entries:
+                self.redis.zadd(self.index_name, {key: time.time()})
+        except RedisError as e:
+            logger.warning(f"LLM cache lookup failed: {e}")
+            return None
+
+        return [loads(generation) for generation in json.loads(value)]
+
+    def update(self, prompt, llm_string, return_val):
+        """Update."""
+        key = self._key(prompt, llm_string)
+        value = json.dumps([dumps(generation) for generation in return_val])
+        try:
+            pipe = self.redis.pipeline()
+            pipe.set(key, value, ex=self.ttl)
+            if self.max_entries:
+                pipe.zadd(self.index_name, {key: time.time()})
+                pipe.zcard(self.index_name)
+            result = pipe.execute()
+
+            if self.max_entries and result[-1] > self.max_entries:
+                self._evict(result[-1] - self.max_entries)
+        except RedisError as e:
+            logger.warning(f"LLM cache update failed: {e}")
+
+    def _evict(self, count):
+        """Evict the least recently used entries."""
+        keys = self.redis.zrange(self.index_name, 0, count - 1)
+        if keys:
+            pipe = self.redis.pipeline()
+            pipe.delete(*keys)
+            pipe.zrem(self.index_name, *keys)
+            pipe.execute()
+
+    def clear(self, **kwargs):
+        """Clear."""
+        keys = self.redis.zrange(self.index_name, 0, -1)
+        pipe = self.redis.pipeline()
+        if keys:
+            pipe.delete(*keys)
+        pipe.delete(self.index_name)
+        pipe.execute()
+
+
+def build_llm_cache(cache_config):
+    """Build the LLM cache configured for the app, or None to disable caching."""
+    backend = cache_config.get("backend")
+
+    if backend == "redis":
+        return RedisLLMCache(r,
+                             ttl=cache_config.get("ttl"),
+                             max_entries=cache_config.get("max_entries"))
+    if backend == "sqlite":
+        os.makedirs(os.path.dirname(cache_config["database_path"]), exist_ok=True)
+        return SQLiteCache(database_path=cache_config["database_path"])
+
+    if backend is not None:
+        logger.warning(f"{backend} is not supported")
+    return None
@@ -2,9 +2,9 @@
 from langchain.chat_models import ChatOpenAI
 from langchain.schema import HumanMessage
 from langchain.embeddings import OpenAIEmbeddings
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
 from config import logger
+from core.llm_processor.embedding_cache import query_embedding_cache
 
 
 class OpenAIProcessor:
@@ -36,8 +36,6 @@ class OpenAIProcessor:
             request_timeout=request_timeout,
             openai_api_key=openai_api_key,
             cache=cache_enable,
-            streaming=True,
-            callbacks=[StreamingStdOutCallbackHandler()],
         )
 
     def complete(self, text):
@@ -47,12 +45,19 @@ class OpenAIProcessor:
             HumanMessage(content=text),
         ]
         response = chat(messages)
-        print("response!!!!!!!!!!",response)
 
         return {
             "result": response.content,
         }
 
+    async def astream(self, text):
+        """Stream the completion token by token."""
+        messages = [
+            HumanMessage(content=text),
+        ]
+        async for chunk in self.llm.astream(messages):
+            yield chunk.content
+
     @staticmethod
     def check_params_dict(params_dict):
         """Check params dict."""
@@ -100,6 +105,12 @@ class OpenAIEmbedding:
         request_timeout=60,
         openai_api_key="",
     ):
+        # Everything but the key determines the vectors, so it is what embeddings are cached by
+        self.cache_params = {
+            "provider": "openai",
+            "model": model,
+            "embedding_ctx_length": embedding_ctx_length,
+        }
         self.embedding_model = OpenAIEmbeddings(
             model=model,
             embedding_ctx_length=embedding_ctx_length,
@@ -111,7 +122,12 @@ class OpenAIEmbedding:
 
     def embed_text(self, text):
         """Embed text."""
-        return self.embedding_model.embed_query(text)
+        key = query_embedding_cache.key(self.cache_params, text)
+        vector = query_embedding_cache.get(key)
+        if vector is None:
+            vector = self.embedding_model.embed_query(text)
+            query_embedding_cache.set(key, vector)
+        return vector
 
     @staticmethod
     def check_params_dict(params_dict):
@@ -0,0 +1,52 @@
+"""Retry."""
+import random
+import time
+
+import anthropic
+import openai
+import requests
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and server side failures
+TRANSIENT_ERROR_TYPES = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    anthropic.RateLimitError,
+    anthropic.APIConnectionError,
+    anthropic.InternalServerError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_transient_error(e):
+    """Whether an error is likely to go away when the call is retried."""
+    if isinstance(e, TRANSIENT_ERROR_TYPES):
+        return True
+    # Other API errors carry the HTTP status, 5xx is on the provider side
+    if isinstance(e, openai.error.APIError):
+        return e.http_status is None or e.http_status >= 500
+    return False
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Seconds to wait before retry number attempt (from 0), exponential with jitter."""
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def call_with_retry(func, max_retries=3, base_delay=2, max_delay=60):
+    """Call func, retrying transient errors up to max_retries times with backoff."""
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= max_retries or not is_transient_error(e):
+                raise
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+            attempt += 1
@@ -1,78 +1,247 @@
 """Task progress."""
+import json
+import time
+
 from connection import r
 
+# Records only back running tasks, the DB keeps the final state
+RECORDS_EXPIRE_SEC = 7 * 24 * 3600  # 7 days
+# Records of a finished task are kept a little longer for clients still polling
+FINISHED_RECORDS_EXPIRE_SEC = 3600
+
+BATCH_TASK_PREFIX = "batch-task"
+EMBEDDING_TASK_PREFIX = "embedding-task"
+
+
+def _to_int(value):
+    return int(value) if value is not None else 0
+
 
 class TaskRedisRecords:
-    """Task redis records."""
+    """Task redis records.
+
+    Counters live in a hash, row results and fail messages in lists next to it. Every update
+    is a single pipelined round trip of atomic HINCRBY/RPUSH commands, so concurrent workers
+    of one task never overwrite each other. Updates are then published on the event channel
+    of the task for listeners to push to clients.
+    """
 
-    def __init__(self, task_id, total=0):
+    def __init__(self, task_id, total=0, prefix=BATCH_TASK_PREFIX):
         self.task_id = task_id
-        self.redis_name = self._assemble_task_redis_name(task_id)
+        self.redis_name = self._assemble_task_redis_name(task_id, prefix)
+        self.result_name = f"{self.redis_name}:{self._result_key()}"
+        self.fail_message_name = f"{self.redis_name}:{self._fail_message_key()}"
+        self.event_name = f"{self.redis_name}:{self._event_key()}"
+        self.app_name = f"{self.redis_name}:{self._app_key()}"
         if total >= 0:
             self.total = total
             self._create_task_redis_records()
 
     def _create_task_redis_records(self):
-        r.hset(name=self.redis_name, items=[
-            {self._total_key(): self.total},
-            {self._done_key(): 0},
-            {self._fail_key(): 0},
-            {self._result_key(): []},
-            {self._active_key(): 1},
-            {self._fail_key(): []},
-        ])
+        pipe = r.pipeline()
+        pipe.delete(self.result_name, self.fail_message_name)
+        pipe.hset(name=self.redis_name, mapping={
+            self._total_key(): self.total,
+            self._done_key(): 0,
+            self._fail_key(): 0,
+            self._active_key(): 1,
+        })
+        pipe.expire(self.redis_name, RECORDS_EXPIRE_SEC)
+        pipe.execute()
 
     def get_task_total(self):
         """Get task total."""
-        return r.hget(self.redis_name, self._total_key())
+        return _to_int(r.hget(self.redis_name, self._total_key()))
 
     def get_task_progress(self):
         """Get task progress."""
-        return r.hget(self.redis_name, self._done_key())
+        return _to_int(r.hget(self.redis_name, self._done_key()))
+
+    def get_progress(self):
+        """Get progress in the format stored with the task, or None without records."""
+        return self._to_progress(
+            r.hmget(self.redis_name, [self._total_key(), self._done_key(), self._fail_key()]))
+
+    @classmethod
+    def get_progress_dict(cls, task_id_list, prefix=BATCH_TASK_PREFIX):
+        """Get the progress of several tasks in one round trip, keyed by task id."""
+        pipe = r.pipeline()
+        for task_id in task_id_list:
+            pipe.hmget(cls._assemble_task_redis_name(task_id, prefix),
+                       [cls._total_key(), cls._done_key(), cls._fail_key()])
+        return {task_id: cls._to_progress(values)
+                for task_id, values in zip(task_id_list, pipe.execute())}
 
-    def increase_task_progress(self):
+    @staticmethod
+    def _to_progress(values):
+        total, done, fail = values
+        if total is None:
+            return None
+        progress = {"total": _to_int(total), "completed": _to_int(done)}
+        if _to_int(fail):
+            progress["failed"] = _to_int(fail)
+        return progress
+
+    def _counter_list(self, pipe):
+        pipe.hmget(self.redis_name, [self._total_key(), self._done_key(), self._fail_key()])
+
+    def _publish(self, event_list):
+        pipe = r.pipeline()
+        for event, data in event_list:
+            pipe.publish(self.event_name, json.dumps({"event": event, "data": data}))
+        pipe.execute()
+
+    def increase_task_progress(self, amount=1):
         """Increase task progress."""
-        r.hincrby(self.redis_name, self._done_key())
+        pipe = r.pipeline()
+        pipe.hincrby(self.redis_name, self._done_key(), amount)
+        self._counter_list(pipe)
+        _, counter_list = pipe.execute()
+        self._publish([("progress", self._to_progress(counter_list))])
 
     def get_task_fail(self):
         """Get task fail."""
-        return r.hget(self.redis_name, self._fail_key())
+        return _to_int(r.hget(self.redis_name, self._fail_key()))
 
-    def increase_task_fail(self):
+    def increase_task_fail(self, amount=1):
         """Increase task fail."""
-        r.hincrby(self.redis_name, self._fail_key())
+        r.hincrby(self.redis_name, self._fail_key(), amount)
 
-    def get_task_result(self):
-        """Get task result."""
-        return r.hget(self.redis_name, self._result_key())
+    def get_task_result(self, start=0, end=-1):
+        """Get task results, from start to end inclusive."""
+        return [json.loads(item) for item in r.lrange(self.result_name, start, end)]
 
     def append_result(self, target):
-        """Append result."""
-        result = self.get_task_result()
-        result.append(target)
-        r.hset(self.redis_name, self._result_key(), result)
+        """Append result and count the row as done."""
+        self.append_result_list([target])
+
+    def append_result_list(self, target_list):
+        """Append results and count the rows as done."""
+        if not target_list:
+            return
+        pipe = r.pipeline()
+        pipe.rpush(self.result_name, *[json.dumps(target) for target in target_list])
+        pipe.hincrby(self.redis_name, self._done_key(), len(target_list))
+        pipe.expire(self.result_name, RECORDS_EXPIRE_SEC)
+        self._counter_list(pipe)
+        length, _, _, counter_list = pipe.execute()
+
+        offset = length - len(target_list)
+        self._publish([("result", {"row_index": offset + index, "result": target})
+                       for index, target in enumerate(target_list)] +
+                      [("progress", self._to_progress(counter_list))])
 
     def is_active(self):
         """Is active."""
-        return r.hget(self.redis_name, self._active_key()) > 0
+        return _to_int(r.hget(self.redis_name, self._active_key())) > 0
+
+    def is_finished(self):
+        """Whether the task has been deactivated, as opposed to not having records yet."""
+        active = r.hget(self.redis_name, self._active_key())
+        return active is not None and _to_int(active) == 0
+
+    def set_app_action_list(self, action_list):
+        """Keep the chain actions the task runs, as they were when it was started."""
+        r.set(self.app_name, json.dumps(action_list), ex=RECORDS_EXPIRE_SEC)
 
-    def deactivate(self):
-        """Deactivate."""
-        r.hset(self.redis_name, self._active_key(), 0)
+    def get_app_action_list(self):
+        """Get the chain actions the task was started with, or None without them."""
+        value = r.get(self.app_name)
+        return json.loads(value) if value is not None else None
+
+    def deactivate(self, status=None):
+        """Deactivate, dropping the row results that are persisted to the DB by now."""
+        pipe = r.pipeline()
+        pipe.hset(self.redis_name, self._active_key(), 0)
+        pipe.delete(self.result_name)
+        pipe.expire(self.redis_name, FINISHED_RECORDS_EXPIRE_SEC)
+        pipe.expire(self.fail_message_name, FINISHED_RECORDS_EXPIRE_SEC)
+        pipe.expire(self.app_name, FINISHED_RECORDS_EXPIRE_SEC)
+        pipe.execute()
+        self._publish([("end", {"status": status})])
 
     def get_fail_message(self):
         """Get fail message."""
-        return r.hget(self.redis_name, self._fail_key())
+        return [item.decode() for item in r.lrange(self.fail_message_name, 0, -1)]
 
     def append_fail_message(self, msg):
-        """Append fail message."""
-        messages = self.get_fail_message()
-        messages.append(msg)
-        r.hset(self.redis_name, self._fail_key(), messages)
+        """Append fail message and count the row as failed."""
+        pipe = r.pipeline()
+        pipe.rpush(self.fail_message_name, msg)
+        pipe.hincrby(self.redis_name, self._fail_key(), 1)
+        pipe.expire(self.fail_message_name, RECORDS_EXPIRE_SEC)
+        self._counter_list(pipe)
+        *_, counter_list = pipe.execute()
+        self._publish([("fail", {"message": msg}),
+                       ("progress", self._to_progress(counter_list))])
+
+    def append_failed_row(self, target, msg):
+        """Append the placeholder result of a failed row and its fail message.
+
+        The placeholder keeps the row indexes of the results after it in line with the
+        input rows, the row counts as failed rather than done.
+        """
+        pipe = r.pipeline()
+        pipe.rpush(self.result_name, json.dumps(target))
+        pipe.rpush(self.fail_message_name, msg)
+        pipe.hincrby(self.redis_name, self._fail_key(), 1)
+        pipe.expire(self.result_name, RECORDS_EXPIRE_SEC)
+        pipe.expire(self.fail_message_name, RECORDS_EXPIRE_SEC)
+        self._counter_list(pipe)
+        length, *_, counter_list = pipe.execute()
+        self._publish([("result", {"row_index": length - 1, "result": target}),
+                       ("fail", {"message": msg}),
+                       ("progress", self._to_progress(counter_list))])
+
+    def iter_events(self, include_results=True, heartbeat_sec=15, max_duration_sec=3600):
+        """Yield (event, data) of the task until it ends, for pushing to a client.
+
+        A snapshot of the progress, and of the results so far, comes first, then live events
+        as they are published. (None, None) is yielded whenever heartbeat_sec passes without
+        an event, and the stream stops after max_duration_sec for the client to reconnect.
+        """
+        deadline = time.monotonic() + max_duration_sec
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        # Subscribe before reading the snapshot so that nothing in between is missed
+        pubsub.subscribe(self.event_name)
+        try:
+            progress = self.get_progress()
+            if progress is not None:
+                yield "progress", progress
+
+            next_row_index = 0
+            if include_results:
+                for target in self.get_task_result():
+                    yield "result", {"row_index": next_row_index, "result": target}
+                    next_row_index += 1
+
+            if self.is_finished():
+                yield "end", {"status": None}
+                return
+
+            while time.monotonic() < deadline:
+                message = pubsub.get_message(timeout=heartbeat_sec)
+                if message is None:
+                    if self.is_finished():
+                        yield "end", {"status": None}
+                        return
+                    yield None, None
+                    continue
+
+                payload = json.loads(message["data"])
+                event, data = payload["event"], payload["data"]
+                if event == "result" and (not include_results or
+                                          data["row_index"] < next_row_index):
+                    continue
+                yield event, data
+                if event == "end":
+                    return
+        finally:
+            pubsub.close()
 
     @staticmethod
-    def _assemble_task_redis_name(task_id):
-        return f"batch-task-{task_id}"
+    def _assemble_task_redis_name(task_id, prefix=BATCH_TASK_PREFIX):
+        return f"{prefix}-{task_id}"
 
     @staticmethod
     def _total_key():
@@ -90,10 +259,18 @@ class TaskRedisRecords:
     def _result_key():
         return "result"
 
+    @staticmethod
+    def _fail_message_key():
+        return "fail-message"
+
+    @staticmethod
+    def _event_key():
+        return "events"
+
     @staticmethod
     def _active_key():
         return "active"
 
     @staticmethod
-    def _fail_key():
-        return "fail"
+    def _app_key():
+        return "app"
@@ -96,3 +96,16 @@ class DbAppTask(DbBase):
         self.app_id = app_id
         self.file_id = file_id
         self.published = published
+
+
+# pylint: disable=too-few-public-methods
+class DbAppTaskResult(DbBase):
+    """DB app task result."""
+    __tablename__ = 't_task_result'
+
+    id = db.Column(INTEGER, primary_key=True, autoincrement=True)
+    task_id = db.Column(String(36), ForeignKey('t_task.id'), nullable=False)
+    row_index = db.Column(INTEGER, nullable=False)
+    result = db.Column(JSON, default=None)
+
+    __table_args__ = (db.UniqueConstraint('task_id', 'row_index'),)
@@ -7,11 +7,13 @@ class DbBase(db.Model):
     """DB base."""
     __abstract__ = True
 
-    def as_dict(self):
+    def as_dict(self, exclude=None):
         """Dict format."""
+        if exclude is None:
+            exclude = []
         result = {}
         for c in self.__table__.columns:
-            if getattr(self, c.name) is not None:
+            if c.name not in exclude and getattr(self, c.name) is not None:
                 if str(c.type) == 'JSON':
                     result[c.name] = getattr(self, c.name)
                 else:
@@ -3,7 +3,7 @@ from datetime import datetime
 
 from sqlalchemy import String, DateTime, INTEGER, ForeignKey, PickleType
 from sqlalchemy.dialects.mysql import JSON
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 
 from connection import db
 from model.application import TaskStatus
@@ -24,8 +24,9 @@ class DbFile(DbBase):
         db.String(36), ForeignKey('t_user.id'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     size = db.Column(db.Integer)
-    content = db.Column(JSON)
-    raw_content = db.Column(PickleType)
+    # The payload columns are only loaded when accessed, or undeferred by a query
+    content = deferred(db.Column(JSON))
+    raw_content = deferred(db.Column(PickleType))
     published = db.Column(db.Boolean, nullable=False, default=False)
     deleted_at = db.Column(db.DateTime, nullable=True)
 
@@ -0,0 +1,239 @@
+"""File storage service."""
+import csv
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import current_app
+
+COPY_BUFFER_SIZE = 1024 * 1024  # 1MB
+RAW_FILE_NAME = "raw"
+ROWS_FILE_NAME = "rows.parquet"
+
+# Cells are only bounded by the upload size, the csv module default of 128KB is lifted
+csv.field_size_limit(2 ** 31 - 1)
+
+
+class _NotATableError(Exception):
+    """Raised when a delimited file turns out not to be a consistent table."""
+
+
+class MissingTableRowsError(Exception):
+    """Raised when the rows of a table file are neither in storage nor in the DB."""
+
+
+def _file_dir(file_id):
+    return os.path.join(current_app.config["FILE_STORE"]["root_path"], file_id)
+
+
+def raw_file_path(file_id):
+    """Path of the uploaded bytes of a file."""
+    return os.path.join(_file_dir(file_id), RAW_FILE_NAME)
+
+
+def rows_file_path(file_id):
+    """Path of the parsed rows of a table file."""
+    return os.path.join(_file_dir(file_id), ROWS_FILE_NAME)
+
+
+def remove_file(file_id):
+    """Remove everything stored for a file."""
+    shutil.rmtree(_file_dir(file_id), ignore_errors=True)
+
+
+def save_upload(file_id, stream, max_size):
+    """Copy an upload stream to storage chunk by chunk, returning its size."""
+    os.makedirs(_file_dir(file_id), exist_ok=True)
+
+    size = 0
+    with open(raw_file_path(file_id), "wb") as raw_file:
+        while True:
+            chunk = stream.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise ValueError(
+                    f"Only files smaller than {max_size // (1024 * 1024)}MB are supported.")
+            raw_file.write(chunk)
+
+    return size
+
+
+def sniff_delimiter(file_id, sample_size):
+    """Guess the delimiter of a table from a bounded sample, or None for plain text.
+
+    The first line decides between tab and comma, every complete line of the sample must
+    contain the same positive number of delimiters.
+    """
+    with open(raw_file_path(file_id), "rb") as raw_file:
+        sample = raw_file.read(sample_size)
+        is_complete = raw_file.read(1) == b""
+
+    line_list = sample.decode("utf-8", errors="ignore").splitlines()
+    if not is_complete:
+        # The last line of a truncated sample is partial
+        line_list = line_list[:-1]
+    if not line_list:
+        return None
+
+    if '\t' in line_list[0]:
+        delimiter = '\t'
+    elif ',' in line_list[0]:
+        delimiter = ','
+    else:
+        return None
+
+    delimiter_counts = {line.count(delimiter) for line in line_list}
+    if len(delimiter_counts) == 1 and delimiter_counts.pop() > 0:
+        return delimiter
+    return None
+
+
+def _iter_checked_lines(text_file, delimiter, delimiter_count):
+    for line in text_file:
+        if line.rstrip("\r\n").count(delimiter) != delimiter_count:
+            raise _NotATableError()
+        yield line
+
+
+def _write_row_group(writer, column_list, row_buffer):
+    columns = {column: [row[index] for row in row_buffer]
+               for index, column in enumerate(column_list)}
+    writer.write_table(pa.Table.from_pydict(columns, schema=writer.schema))
+    row_buffer.clear()
+
+
+def _iter_csv_rows(reader):
+    try:
+        yield from reader
+    except csv.Error as e:
+        raise _NotATableError() from e
+
+
+def _write_table_rows(file_id, delimiter, max_rows, chunk_size):
+    """Parse the raw file row by row and write the rows as Parquet, one row group per chunk.
+
+    Cells are stored as strings, a repeated column name keeps its last value. A file the csv
+    module cannot parse, such as one with unbalanced quotes, is not a table.
+    """
+    row_count = 0
+    with open(raw_file_path(file_id), encoding="utf-8", newline="") as text_file:
+        delimiter_count = text_file.readline().count(delimiter)
+        text_file.seek(0)
+
+        row_iter = _iter_csv_rows(csv.reader(
+            _iter_checked_lines(text_file, delimiter, delimiter_count), delimiter=delimiter))
+        header = next(row_iter, None)
+        if header is None:
+            raise _NotATableError()
+        column_list = list(dict.fromkeys(header))
+        schema = pa.schema([(column, pa.string()) for column in column_list])
+
+        with pq.ParquetWriter(rows_file_path(file_id), schema) as writer:
+            row_buffer = []
+            for values in row_iter:
+                row_count += 1
+                if row_count > max_rows:
+                    raise ValueError(
+                        f"Only tables with less than {max_rows} rows are supported.")
+
+                row = dict.fromkeys(column_list)
+                row.update(zip(header, values))
+                row_buffer.append(list(row.values()))
+                if len(row_buffer) >= chunk_size:
+                    _write_row_group(writer, column_list, row_buffer)
+
+            if row_buffer or row_count == 0:
+                _write_row_group(writer, column_list, row_buffer)
+
+    return row_count
+
+
+def ingest_upload(file_id):
+    """Determine whether a stored upload is a table or plain text and ingest it.
+
+    Tables are parsed incrementally into row storage and keep no content in the DB, plain
+    text is returned as content and so is held to the lower max_text_size.
+    """
+    store_config = current_app.config["FILE_STORE"]
+
+    delimiter = sniff_delimiter(file_id, store_config["sniff_size"])
+    if delimiter:
+        try:
+            row_count = _write_table_rows(file_id, delimiter, store_config["max_table_rows"],
+                                          store_config["row_chunk_size"])
+            return "Table", None, row_count
+        except _NotATableError:
+            os.remove(rows_file_path(file_id))
+
+    max_text_size = store_config["max_text_size"]
+    if os.path.getsize(raw_file_path(file_id)) > max_text_size:
+        raise ValueError(
+            f"Only text files smaller than {max_text_size // (1024 * 1024)}MB are supported.")
+
+    with open(raw_file_path(file_id), encoding="utf-8") as text_file:
+        text_content = text_file.read()
+    return "Plain Text", {"text": text_content}, 0
+
+
+def _legacy_table_rows(file_data):
+    """Rows of a table uploaded before row storage existed, kept in the content column."""
+    if file_data.content is None:
+        raise MissingTableRowsError(f"Rows of file {file_data.id} are missing from storage")
+    return file_data.content
+
+
+def count_table_rows(file_data):
+    """Number of rows of a table file, read from the Parquet footer."""
+    path = rows_file_path(file_data.id)
+    if not os.path.exists(path):
+        return len(_legacy_table_rows(file_data))
+
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def iter_table_rows(file_data, offset=0, limit=None):
+    """Iterate over rows of a table file, reading one row group at a time.
+
+    Row groups entirely before offset are skipped without being read. Files uploaded before
+    row storage existed are read from the content column.
+    """
+    stop = None if limit is None else offset + limit
+    path = rows_file_path(file_data.id)
+    if not os.path.exists(path):
+        yield from _legacy_table_rows(file_data)[offset:stop]
+        return
+
+    parquet_file = pq.ParquetFile(path)
+    group_start = 0
+    for group_index in range(parquet_file.num_row_groups):
+        if stop is not None and group_start >= stop:
+            return
+        group_rows = parquet_file.metadata.row_group(group_index).num_rows
+        group_end = group_start + group_rows
+        if group_end > offset:
+            row_list = parquet_file.read_row_group(group_index).to_pylist()
+            yield from row_list[max(offset - group_start, 0):
+                                None if stop is None else stop - group_start]
+        group_start = group_end
+
+
+def load_table_columns(file_data):
+    """Load a table file as {column: {row index: value}}, the DataFrame 'columns' layout."""
+    path = rows_file_path(file_data.id)
+    if not os.path.exists(path):
+        columns = {}
+        for index, row in enumerate(_legacy_table_rows(file_data)):
+            for column, value in row.items():
+                columns.setdefault(column, {})[str(index)] = value
+        return columns
+
+    return {column: {str(index): value for index, value in enumerate(value_list)}
+            for column, value_list in pq.read_table(path).to_pydict().items()}
+
+
+def has_raw_file(file_id):
+    """Whether the uploaded bytes of a file are in storage."""
+    return os.path.exists(raw_file_path(file_id))
@@ -0,0 +1,201 @@
+"""Quota ledger."""
+from datetime import datetime
+
+from celery import shared_task
+from flask import current_app
+from sqlalchemy import update
+
+from config import logger
+from connection import db, r
+from model.user import DbUserQuota
+
+LEDGER_NAMESPACE = "quota-ledger"
+DIRTY_USER_SET_NAME = f"{LEDGER_NAMESPACE}:dirty"
+RESERVATION_NAMESPACE = f"{LEDGER_NAMESPACE}:reservation"
+# A reservation that is never settled keeps its quota spent
+RESERVATION_EXPIRE_SEC = 7 * 24 * 3600  # 7 days
+DEFAULT_QUOTA_AVAILABLE = 100
+DEFAULT_IDLE_TTL = 300
+
+# Consumed amounts move from available to used and are added to the pending amount that
+# has not reached t_user_quota yet. Returns the remaining quota, -1 when it is insufficient
+# or -2 when the user is not loaded. A negative amount gives quota back. An entry with a
+# pending amount must not expire before it is flushed, hence the PERSIST.
+_CONSUME_SCRIPT = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -2
+end
+local amount = tonumber(ARGV[1])
+local available = tonumber(redis.call('HGET', KEYS[1], 'available'))
+if amount == 0 then
+    return available
+end
+if amount > 0 and available < amount then
+    return -1
+end
+redis.call('HINCRBY', KEYS[1], 'available', -amount)
+redis.call('HINCRBY', KEYS[1], 'used', amount)
+redis.call('HINCRBY', KEYS[1], 'pending', amount)
+redis.call('PERSIST', KEYS[1])
+redis.call('SADD', KEYS[2], ARGV[2])
+return available - amount
+""")
+
+_LOAD_SCRIPT = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'available', ARGV[1], 'used', ARGV[2], 'pending', 0)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+""")
+
+_TAKE_PENDING_SCRIPT = r.register_script("""
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local pending = tonumber(redis.call('HGET', KEYS[1], 'pending'))
+redis.call('HSET', KEYS[1], 'pending', 0)
+return pending
+""")
+
+# Dropping a synced entry makes the next use reload it, picking up changes made to
+# t_user_quota directly
+_RELEASE_SCRIPT = r.register_script("""
+if tonumber(redis.call('HGET', KEYS[1], 'pending') or '0') == 0 then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+""")
+
+
+class QuotaLedger:
+    """Quota ledger.
+
+    Quota is held and spent in Redis, every spend is a single atomic script that cannot take
+    the available quota below zero. The spent amounts are flushed to t_user_quota in the
+    background by flush_quota_ledger.
+    """
+
+    @staticmethod
+    def _ledger_name(user_id):
+        return f"{LEDGER_NAMESPACE}:{user_id}"
+
+    @classmethod
+    def _load(cls, user_id):
+        user_quota = DbUserQuota.query.filter_by(user_id=user_id).first()
+        if user_quota is None:
+            user_quota = DbUserQuota(
+                user_id=user_id,
+                quota_available=DEFAULT_QUOTA_AVAILABLE,
+                quota_used=0,
+                updated_at=datetime.utcnow())
+            db.session.add(user_quota)
+            db.session.commit()
+
+        idle_ttl = current_app.config.get("QUOTA_LEDGER", {}).get("idle_ttl", DEFAULT_IDLE_TTL)
+        _LOAD_SCRIPT(keys=[cls._ledger_name(user_id)],
+                     args=[user_quota.quota_available, user_quota.quota_used, idle_ttl])
+
+    @classmethod
+    def get(cls, user_id):
+        """Get the available and used quota of a user."""
+        name = cls._ledger_name(user_id)
+        available, used = r.hmget(name, ["available", "used"])
+        if available is None:
+            cls._load(user_id)
+            available, used = r.hmget(name, ["available", "used"])
+        return {"quota_available": int(available), "quota_used": int(used)}
+
+    @classmethod
+    def consume(cls, user_id, amount):
+        """Consume quota, returning the remaining quota or None when it is insufficient."""
+        keys = [cls._ledger_name(user_id), DIRTY_USER_SET_NAME]
+        remaining = _CONSUME_SCRIPT(keys=keys, args=[amount, user_id])
+        if remaining == -2:
+            cls._load(user_id)
+            remaining = _CONSUME_SCRIPT(keys=keys, args=[amount, user_id])
+        return None if remaining < 0 else remaining
+
+    @classmethod
+    def reserve(cls, reservation_id, user_id, amount, unit_amount):
+        """Spend the quota of a whole job up front, returning whether there was enough of it.
+
+        The job then runs without touching the ledger, settle keeps the quota of the units it
+        completed and gives the rest back.
+        """
+        if amount <= 0:
+            return True
+        if cls.consume(user_id, amount) is None:
+            return False
+
+        name = f"{RESERVATION_NAMESPACE}:{reservation_id}"
+        pipe = r.pipeline()
+        pipe.hset(name, mapping={
+            "user_id": user_id, "amount": amount, "unit_amount": unit_amount})
+        pipe.expire(name, RESERVATION_EXPIRE_SEC)
+        pipe.execute()
+        return True
+
+    @classmethod
+    def settle(cls, reservation_id, completed_units):
+        """Settle a reservation once, refunding the quota of the units not completed."""
+        name = f"{RESERVATION_NAMESPACE}:{reservation_id}"
+        # Reading and deleting in one transaction settles a reservation exactly once, even
+        # when a stop request and the job itself both settle it
+        pipe = r.pipeline()
+        pipe.hgetall(name)
+        pipe.delete(name)
+        reservation, _ = pipe.execute()
+        if not reservation:
+            return 0
+
+        amount = int(reservation[b"amount"])
+        refund = amount - min(amount, completed_units * int(reservation[b"unit_amount"]))
+        if refund > 0:
+            cls.consume(reservation[b"user_id"].decode(), -refund)
+        return refund
+
+    @classmethod
+    def flush(cls):
+        """Apply the pending amounts of every changed user to t_user_quota."""
+        flushed_count = 0
+        for user_id in r.smembers(DIRTY_USER_SET_NAME):
+            user_id = user_id.decode()
+            name = cls._ledger_name(user_id)
+            pending = _TAKE_PENDING_SCRIPT(keys=[name, DIRTY_USER_SET_NAME], args=[user_id])
+            if not pending:
+                # Spending that netted out to nothing, such as a fully refunded reservation
+                _RELEASE_SCRIPT(keys=[name])
+                continue
+
+            try:
+                db.session.execute(
+                    update(DbUserQuota)
+                    .where(DbUserQuota.user_id == user_id)
+                    .values(quota_used=DbUserQuota.quota_used + pending,
+                            quota_available=DbUserQuota.quota_available - pending,
+                            updated_at=datetime.utcnow()))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                # Hand the amount back so that the next flush retries it
+                pipe = r.pipeline()
+                pipe.hincrby(name, "pending", pending)
+                pipe.sadd(DIRTY_USER_SET_NAME, user_id)
+                pipe.execute()
+                logger.warning(f"Quota ledger flush failed for user {user_id}: {e}")
+                continue
+
+            _RELEASE_SCRIPT(keys=[name])
+            flushed_count += 1
+
+        return flushed_count
+
+
+@shared_task(ignore_result=True)
+def flush_quota_ledger():
+    """Flush quota ledger, run periodically by celery beat."""
+    return QuotaLedger.flush()
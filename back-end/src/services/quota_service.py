@@ -1,10 +1,6 @@
 """Quota service."""
-from datetime import datetime
-
-from model.user import DbUserQuota
-from sqlalchemy.exc import SQLAlchemyError
-from connection import db
-from services.user_api_key_service import get_selected_user_api_key_type_or_none
+from services.quota_ledger import QuotaLedger
+from services.user_api_key_service import get_user_api_key_resolver
 
 
 class QuotaService:
@@ -13,48 +9,36 @@ class QuotaService:
     @staticmethod
     def check_user_quota(user_id):
         """Check user quota."""
-        user_quota = DbUserQuota.query.filter_by(user_id=user_id).first()
-        if user_quota:
-            return {
-                "quota_available": user_quota.quota_available,
-                "quota_used": user_quota.quota_used
-            }
-
-        return {"error": "Quota information not found for the user"}, 404
+        return QuotaLedger.get(user_id)
 
     @staticmethod
     def update_user_quota(user_id, amount):
         """Update user quota."""
-        try:
-            user_quota = DbUserQuota.query.filter_by(user_id=user_id).first()
-            if user_quota:
-                user_quota.update_quota(amount)
-            else:
-                user_quota = DbUserQuota(
-                    user_id=user_id,
-                    quota_available=100 - amount,
-                    quota_used=amount,
-                    updated_at=datetime.utcnow())
-                db.session.add(user_quota)
-            db.session.commit()
-            return {"message": "Quota updated successfully"}, 200
-        except ValueError as e:
-            db.session.rollback()
-            return {"error": str(e)}, 403
-        except SQLAlchemyError:
-            db.session.rollback()
-            raise
+        if QuotaLedger.consume(user_id, amount) is None:
+            return {"error": "Quota limit exceeded. Please provide your API key."}, 403
+        return {"message": "Quota updated successfully"}, 200
+
+    @staticmethod
+    def reserve_user_quota(reservation_id, user_id, amount, unit_amount):
+        """Reserve quota for a job of amount / unit_amount units, False when insufficient."""
+        return QuotaLedger.reserve(reservation_id, user_id, amount, unit_amount)
+
+    @staticmethod
+    def settle_user_quota(reservation_id, completed_units):
+        """Settle reserved quota, refunding the units not completed."""
+        return QuotaLedger.settle(reservation_id, completed_units)
 
     @staticmethod
     def calculate_app_quota(user_id, data):
         """Calcuate app quota."""
         quota_needed = 0
         model_providers = {"openai", "google", "anthropic"}
+        api_key_resolver = get_user_api_key_resolver(user_id)
 
         for entry in data:
             model_provider = entry.get("model_provider")
             if (model_provider in model_providers and
-                    get_selected_user_api_key_type_or_none(model_provider, user_id) is None):
+                    api_key_resolver.get_api_key_type_or_none(model_provider) is None):
                 quota_needed += 1
                 model_name =  entry.get("parameters", {}).get("model_name")
 
@@ -71,7 +55,8 @@ class QuotaService:
 
         model_provider = data.get("model_provider")
         if (model_provider in model_providers and
-                get_selected_user_api_key_type_or_none(model_provider, user_id) is None):
+                get_user_api_key_resolver(user_id).get_api_key_type_or_none(model_provider)
+                is None):
             quota_needed += 1
 
             model_name = data.get("parameters", {}).get("model_name")
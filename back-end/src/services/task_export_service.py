@@ -0,0 +1,137 @@
+"""Task export service."""
+import csv
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from core.interface.ops_interface import load_task_result_page, result_column_list
+from services.file_storage_service import iter_table_rows
+
+EXPORT_MIMETYPES = {
+    "csv": "text/csv",
+    "tsv": "text/tab-separated-values",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting what is written to it until drained."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunk_list = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunk_list.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        """Return and forget everything written since the last drain."""
+        data = b"".join(self.chunk_list)
+        self.chunk_list.clear()
+        return data
+
+
+def _to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _iter_joined_pages(task_build, file_data, page_size):
+    """Yield pages of input rows joined with their results on the row index.
+
+    Only rows that have a result are exported, a result column wins over an input column
+    of the same name.
+    """
+    input_rows = enumerate(iter_table_rows(file_data))
+    input_index, input_row = -1, None
+    offset = 0
+    while True:
+        result_list = load_task_result_page(task_build, offset, page_size)
+        page = []
+        # Results come in row order, input rows without a result are skipped
+        for row_index, res in result_list:
+            while input_index < row_index:
+                input_index, input_row = next(input_rows, (float("inf"), None))
+            if input_index == row_index:
+                page.append({**input_row, **res})
+        if page:
+            yield page
+        if len(result_list) < page_size:
+            return
+        offset += len(result_list)
+
+
+def _iter_delimited(page_iter, column_list_of, delimiter):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter)
+    column_list = None
+    for page in page_iter:
+        if column_list is None:
+            column_list = column_list_of(page[0])
+            writer.writerow(column_list)
+        for row in page:
+            writer.writerow([_to_text(row.get(column)) for column in column_list])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+
+def _iter_jsonl(page_iter):
+    for page in page_iter:
+        yield "".join(json.dumps(row) + "\n" for row in page)
+
+
+def _iter_parquet(page_iter, column_list_of):
+    sink = _ChunkSink()
+    writer = None
+    column_list = None
+    for page in page_iter:
+        if writer is None:
+            column_list = column_list_of(page[0])
+            writer = pq.ParquetWriter(
+                sink, pa.schema([(column, pa.string()) for column in column_list]))
+        writer.write_table(pa.Table.from_pydict(
+            {column: [_to_text(row.get(column)) for row in page] for column in column_list},
+            schema=writer.schema))
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def iter_task_export(task_build, file_data, export_format, page_size):
+    """Iterate over the chunks of a task export, one page of rows at a time.
+
+    The input rows of the task file are joined with the row results, neither is ever held
+    in memory beyond the current page.
+    """
+    page_iter = _iter_joined_pages(task_build, file_data, page_size)
+
+    def column_list_of(sample_row):
+        return result_column_list(task_build, sample_row)
+
+    if export_format == "csv":
+        return _iter_delimited(page_iter, column_list_of, ",")
+    if export_format == "tsv":
+        return _iter_delimited(page_iter, column_list_of, "\t")
+    if export_format == "jsonl":
+        return _iter_jsonl(page_iter)
+    if export_format == "parquet":
+        return _iter_parquet(page_iter, column_list_of)
+    raise ValueError(f"{export_format} export is not supported")
@@ -1,45 +1,144 @@
 """User API key service."""
-from flask import current_app
+import json
 
+from flask import current_app, g, has_app_context
+from redis.exceptions import RedisError
+
+from config import logger
+from connection import r
 from core.auth.authenticator import get_current_user
 from model.user import DbUserApiKey
 
+API_KEY_CACHE_NAMESPACE = "user-api-keys"
+
+
+class UserApiKeyResolver:
+    """API keys of a user, loaded with a single query and resolved in memory."""
+
+    def __init__(self, user_id, api_key_list):
+        self.user_id = user_id
+        # Newest first, as the keys have always been listed
+        self.api_key_list = api_key_list
+
+    @classmethod
+    def load(cls, user_id):
+        """Load all API keys of a user."""
+        api_keys = DbUserApiKey.query.filter_by(user_id=user_id).order_by(
+            DbUserApiKey.create_at.desc()).all()
+        return cls(user_id, list(map(lambda x: x.as_dict(), api_keys)))
+
+    def get_api_keys(self, t=None):
+        """Get API keys, of a type when given."""
+        if t:
+            return [api_key for api_key in self.api_key_list if api_key['api_type'] == t]
+        return list(self.api_key_list)
+
+    def get_api_key_type_or_none(self, t):
+        """Get API key type or None."""
+        api_keys = self.get_api_keys(t)
+        if len(api_keys) == 0:
+            return None
+        return api_keys[-1]
+
+    def get_api_key_type_or_public(self, t):
+        """Get API key type or public."""
+        api_key = self.get_api_key_type_or_none(t)
+        if api_key:
+            return api_key['api_key']
+        return _get_public_api_key(t)
+
+    def get_llm_api_key_dict(self):
+        """Get the LLM API key dict, as built by the task APIs."""
+        return {
+            "openai_api_key": self.get_api_key_type_or_public("openai"),
+            "anthropic_api_key": self.get_api_key_type_or_public("anthropic"),
+            "google_search_api_key": self.get_api_key_type_or_public("google_search")
+        }
+
+
+def _get_public_api_key(t):
+    if t == "openai":
+        return current_app.config.get("OPENAI_API_KEY")
+    elif t == "anthropic":
+        return current_app.config.get("ANTHROPIC_API_KEY")
+    elif t == "google_search":
+        return current_app.config.get("GOOGLE_SEARCH_API_KEY")
+    else:
+        return None
+
+
+def _redis_cache_config():
+    cache_config = current_app.config.get("USER_API_KEY_CACHE", {})
+    return cache_config if cache_config.get("redis", False) else None
+
+
+def _load_user_api_key_resolver(user_id):
+    cache_config = _redis_cache_config()
+    if cache_config is None:
+        return UserApiKeyResolver.load(user_id)
+
+    name = f"{API_KEY_CACHE_NAMESPACE}:{user_id}"
+    try:
+        value = r.get(name)
+        if value is not None:
+            return UserApiKeyResolver(user_id, json.loads(value))
+    except RedisError as e:
+        logger.warning(f"User API key cache lookup failed: {e}")
+
+    resolver = UserApiKeyResolver.load(user_id)
+    try:
+        r.set(name, json.dumps(resolver.api_key_list), ex=cache_config.get("ttl", 60))
+    except RedisError as e:
+        logger.warning(f"User API key cache update failed: {e}")
+    return resolver
+
+
+def get_user_api_key_resolver(user_id):
+    """Get the API key resolver of a user, loaded once per request or task."""
+    if not has_app_context():
+        return UserApiKeyResolver.load(user_id)
+
+    if "user_api_key_resolver_dict" not in g:
+        g.user_api_key_resolver_dict = {}
+    if user_id not in g.user_api_key_resolver_dict:
+        g.user_api_key_resolver_dict[user_id] = _load_user_api_key_resolver(user_id)
+    return g.user_api_key_resolver_dict[user_id]
+
+
+def invalidate_user_api_keys(user_id):
+    """Forget the cached API keys of a user after they change."""
+    if has_app_context() and "user_api_key_resolver_dict" in g:
+        g.user_api_key_resolver_dict.pop(user_id, None)
+
+    if _redis_cache_config() is not None:
+        try:
+            r.delete(f"{API_KEY_CACHE_NAMESPACE}:{user_id}")
+        except RedisError as e:
+            logger.warning(f"User API key cache invalidation failed: {e}")
+
 
 def get_current_user_api_keys(t=None):
     """Get current user API keys."""
     user = get_current_user()
     if not user:
         return []
-    if t:
-        api_keys = DbUserApiKey.query.filter_by(user_id=user.get_id(), api_type=t).order_by(
-            DbUserApiKey.create_at.desc()).all()
-    else:
-        api_keys = DbUserApiKey.query.filter_by(user_id=user.get_id()).order_by(
-            DbUserApiKey.create_at.desc()).all()
-    return list(map(lambda x: x.as_dict(), api_keys))
+    return get_user_api_key_resolver(user.get_id()).get_api_keys(t)
 
 
 def get_current_user_api_key_type_or_none(t):
     """Get current user API key type or None."""
-    api_keys = get_current_user_api_keys(t)
-    if len(api_keys) == 0:
+    user = get_current_user()
+    if not user:
         return None
-    return api_keys[-1]
+    return get_user_api_key_resolver(user.get_id()).get_api_key_type_or_none(t)
 
 
 def get_current_user_api_key_type_or_public(t):
     """Get current user API key type or public."""
-    api_key = get_current_user_api_key_type_or_none(t)
-    if api_key:
-        return api_key['api_key']
-    elif t == "openai":
-        return current_app.config.get("OPENAI_API_KEY")
-    elif t == "anthropic":
-        return current_app.config.get("ANTHROPIC_API_KEY")
-    elif t == "google_search":
-        return current_app.config.get("GOOGLE_SEARCH_API_KEY")
-    else:
-        return api_key
+    user = get_current_user()
+    if not user:
+        return _get_public_api_key(t)
+    return get_user_api_key_resolver(user.get_id()).get_api_key_type_or_public(t)
 
 
 def get_current_user_specified_api_key(t, key):
@@ -51,8 +150,14 @@ def get_current_user_specified_api_key(t, key):
 
 def get_selected_user_api_key_type_or_none(t, user_id):
     """Get selected user API key type or none."""
-    api_keys = DbUserApiKey.query.filter_by(user_id=user_id, api_type=t).all()
-    api_keys = list(map(lambda x: x.as_dict(), api_keys))
-    if len(api_keys) == 0:
-        return None
-    return api_keys[-1]
+    return get_user_api_key_resolver(user_id).get_api_key_type_or_none(t)
+
+
+def get_selected_user_api_key_type_or_public(t, user_id):
+    """Get selected user API key type or public."""
+    return get_user_api_key_resolver(user_id).get_api_key_type_or_public(t)
+
+
+def get_selected_user_llm_api_key_dict(user_id):
+    """Get the LLM API key dict of a selected user, as built by the task APIs."""
+    return get_user_api_key_resolver(user_id).get_llm_api_key_dict()
@@ -0,0 +1,122 @@
+import sys
+import threading
+import time
+import unittest
+
+from flask import Flask
+
+sys.path.append("../")
+
+from config import BaseConfig
+from core.interface.ops_interface import _run_table_rows
+
+
+class FakeChain:
+    """Chain stand-in echoing the row, with per-row delays and errors."""
+
+    def __init__(self, delay_of=None, error_of=None):
+        self.delay_of = delay_of or {}
+        self.error_of = error_of or {}
+        self.log = []
+        self.lock = threading.Lock()
+
+    def run(self, input_variables):
+        row = input_variables["row"]
+        with self.lock:
+            self.log.append(("start", row, time.monotonic()))
+        time.sleep(self.delay_of.get(row, 0.0))
+        error_list = self.error_of.get(row)
+        if error_list:
+            raise error_list.pop(0)
+        with self.lock:
+            self.log.append(("end", row, time.monotonic()))
+        return {"out": f"{input_variables['prefix']}{row}"}
+
+    def time_of(self, event, row):
+        return next(t for e, r, t in self.log if e == event and r == row)
+
+    def started_rows(self):
+        return [r for e, r, _ in self.log if e == "start"]
+
+
+def _table_rows(count):
+    return [{"row": row} for row in range(count)]
+
+
+class TestRunTableRows(unittest.TestCase):
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.from_object(BaseConfig)
+        app.config["BATCH_ROW_RETRY_BASE_DELAY_SEC"] = 0
+        app.config["BATCH_ROW_RETRY_MAX_DELAY_SEC"] = 0
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+    def _run(self, chain, row_count, concurrency):
+        return list(_run_table_rows(chain, {"prefix": "r"}, _table_rows(row_count), concurrency))
+
+    def test_results_are_in_input_order(self):
+        chain = FakeChain(delay_of={0: 0.05, 2: 0.02})
+
+        res_list = self._run(chain, 6, 3)
+
+        self.assertEqual([({"out": f"r{row}"}, None) for row in range(6)], res_list)
+
+    def test_slow_first_row_does_not_hold_up_the_others(self):
+        chain = FakeChain(delay_of={0: 0.3})
+
+        res_list = self._run(chain, 8, 2)
+
+        self.assertEqual([{"out": f"r{row}"} for row in range(8)], [res for res, _ in res_list])
+        # Row 0 runs on one worker while the other worker goes through the rows after it
+        self.assertLess(chain.time_of("end", 4), chain.time_of("end", 0))
+
+    def test_failed_row_keeps_its_place(self):
+        chain = FakeChain(error_of={1: [ValueError("bad row")]})
+
+        res_list = self._run(chain, 3, 2)
+
+        self.assertEqual([({"out": "r0"}, None), (None, "bad row"), ({"out": "r2"}, None)],
+                         res_list)
+        self.assertEqual(1, chain.started_rows().count(1))
+
+    def test_error_without_message_is_named(self):
+        chain = FakeChain(error_of={0: [KeyError()]})
+
+        self.assertEqual([(None, "KeyError")], self._run(chain, 1, 1))
+
+    def test_transient_error_is_retried(self):
+        chain = FakeChain(error_of={0: [TimeoutError(), TimeoutError()]})
+
+        self.assertEqual([({"out": "r0"}, None)], self._run(chain, 1, 1))
+        self.assertEqual(3, chain.started_rows().count(0))
+
+    def test_closing_early_drops_rows_not_started(self):
+        chain = FakeChain(delay_of={row: 0.05 for row in range(20)})
+
+        row_iter = _run_table_rows(chain, {"prefix": "r"}, _table_rows(20), 1)
+        next(row_iter)
+        row_iter.close()
+
+        self.assertLessEqual(len(chain.started_rows()), 2)
+
+    def test_window_bounds_rows_read_ahead(self):
+        read_list = []
+
+        def table_rows():
+            for row in range(50):
+                read_list.append(row)
+                yield {"row": row}
+
+        chain = FakeChain(delay_of={0: 0.2})
+        row_iter = _run_table_rows(chain, {"prefix": "r"}, table_rows(), 2)
+        next(row_iter)
+
+        # Two rows running at most four times over, while row 0 holds up the order
+        self.assertLessEqual(len(read_list), 2 * BaseConfig.BATCH_TASK_ROW_WINDOW_FACTOR + 1)
+        row_iter.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
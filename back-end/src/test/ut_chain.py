@@ -0,0 +1,136 @@
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append("../")
+
+from core.component.chain import Chain
+from core.component.text import Text
+
+
+class FakePrompt:
+    """Prompt stand-in echoing its rendered text, logging when each call starts and ends."""
+
+    def __init__(self, name, log, delay=0.0, error=None):
+        self.name = name
+        self.log = log
+        self.delay = delay
+        self.error = error
+
+    def complete(self, text_obj, input_variables=None, on_token=None):
+        self.log.append(("start", self.name, time.monotonic()))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        res = text_obj.text_convert(input_variables=input_variables)
+        if on_token is not None:
+            on_token(res)
+        self.log.append(("end", self.name, time.monotonic()))
+        return res
+
+
+def _time_of(log, event, name):
+    return next(t for e, n, t in log if e == event and n == name)
+
+
+class TestChain(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.lock = threading.Lock()
+
+    def _add_prompt(self, chain, name, template, delay=0.0, error=None, is_output=True):
+        chain.add_prompt(FakePrompt(name, self.log, delay, error), Text(template), name,
+                         is_output=is_output)
+
+    def test_dependent_action_sees_upstream_output(self):
+        chain = Chain(max_workers=4)
+        self._add_prompt(chain, "p1", "about {topic}")
+        self._add_prompt(chain, "p2", "[{p1}]")
+
+        res = chain.run({"topic": "socks"})
+
+        self.assertEqual({"p1": "about socks", "p2": "[about socks]"}, res)
+
+    def test_dependent_action_starts_after_its_dependency(self):
+        chain = Chain(max_workers=4)
+        self._add_prompt(chain, "p1", "a", delay=0.1)
+        self._add_prompt(chain, "p2", "{p1}b")
+
+        chain.run()
+
+        self.assertGreaterEqual(_time_of(self.log, "start", "p2"),
+                                _time_of(self.log, "end", "p1"))
+
+    def test_independent_actions_run_concurrently(self):
+        chain = Chain(max_workers=4)
+        self._add_prompt(chain, "p1", "a", delay=0.3)
+        self._add_prompt(chain, "p2", "b", delay=0.3)
+        self._add_prompt(chain, "p3", "{p1}{p2}")
+
+        start = time.monotonic()
+        res = chain.run()
+
+        self.assertLess(time.monotonic() - start, 0.55)
+        self.assertEqual("ab", res["p3"])
+        self.assertLess(_time_of(self.log, "start", "p2"), _time_of(self.log, "end", "p1"))
+
+    def test_later_producer_is_not_a_dependency(self):
+        # p1 references a name only produced after it, it sees the input variable as it
+        # would have when actions ran in list order
+        chain = Chain(max_workers=4)
+        self._add_prompt(chain, "p1", "{p2}")
+        self._add_prompt(chain, "p2", "produced")
+
+        res = chain.run({"p2": "input"})
+
+        self.assertEqual({"p1": "input", "p2": "produced"}, res)
+
+    def test_sequential_run_matches_parallel_run(self):
+        outputs = []
+        for max_workers in (1, 4):
+            chain = Chain(max_workers=max_workers)
+            self._add_prompt(chain, "p1", "x{v}")
+            self._add_prompt(chain, "p2", "y{v}")
+            self._add_prompt(chain, "p3", "{p2}{p1}")
+            outputs.append(chain.run({"v": 1}))
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual("y1x1", outputs[0]["p3"])
+
+    def test_outputs_only_include_output_actions(self):
+        chain = Chain(max_workers=4)
+        self._add_prompt(chain, "hidden", "h", is_output=False)
+        self._add_prompt(chain, "shown", "{hidden}s")
+
+        self.assertEqual({"shown": "hs"}, chain.run())
+        self.assertEqual(["shown"], chain.output_names())
+
+    def test_callback_receives_tokens_and_actions(self):
+        chain = Chain(max_workers=4)
+        self._add_prompt(chain, "p1", "a")
+        self._add_prompt(chain, "p2", "{p1}b")
+        event_list = []
+
+        def callback(event, data):
+            with self.lock:
+                event_list.append((event, data))
+
+        chain.run(callback=callback)
+
+        self.assertIn(("token", {"name": "p1", "token": "a"}), event_list)
+        self.assertEqual(["p1", "p2"], [data["name"] for event, data in event_list
+                                        if event == "action"])
+
+    def test_error_propagates(self):
+        chain = Chain(max_workers=4)
+        self._add_prompt(chain, "p1", "a", error=RuntimeError("boom"))
+        self._add_prompt(chain, "p2", "{p1}")
+
+        with self.assertRaises(RuntimeError):
+            chain.run()
+        self.assertNotIn("p2", [name for _, name, _ in self.log])
+
+
+if __name__ == "__main__":
+    unittest.main()
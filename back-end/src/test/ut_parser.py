@@ -0,0 +1,51 @@
+import sys
+import unittest
+
+sys.path.append("../")
+
+from core.component.parser import ALL_OCCURRENCES, TagParser, compile_tag_pattern
+from core.component.text import Text
+
+TEXT = "<a>first</a> noise <A >second< /a > <b>other</b> <a>\nthird\n</a>"
+
+
+class TestTagParser(unittest.TestCase):
+    def test_first_occurrence_by_default(self):
+        self.assertEqual("first", TagParser("a").extract(TEXT))
+
+    def test_indexed_occurrences(self):
+        self.assertEqual("second", TagParser("a", 1).extract(TEXT))
+        self.assertEqual("\nthird\n", TagParser("a", -1).extract(TEXT))
+        self.assertEqual("second", TagParser("a", "1").extract(TEXT))
+
+    def test_all_occurrences(self):
+        self.assertEqual("first\nsecond\n\nthird\n", TagParser("a", "all").extract(TEXT))
+        self.assertEqual(ALL_OCCURRENCES, TagParser("a", "ALL").occurrence)
+
+    def test_missing_occurrence(self):
+        self.assertIsNone(TagParser("a", 5).extract(TEXT))
+        self.assertIsNone(TagParser("c").extract(TEXT))
+
+    def test_invalid_occurrence(self):
+        for occurrence in ("first", None, True, [1]):
+            with self.assertRaises(ValueError):
+                TagParser("a", occurrence)
+
+    def test_tag_is_escaped(self):
+        self.assertEqual("x", TagParser("a.b").extract("<a.b>x</a.b><aXb>y</aXb>"))
+        self.assertIsNone(TagParser("a.b").extract("<aXb>y</aXb>"))
+
+    def test_pattern_is_cached(self):
+        self.assertIs(compile_tag_pattern("cached"), compile_tag_pattern("cached"))
+
+    def test_parse_renders_template(self):
+        res = TagParser("name").parse(Text("<name>{value}</name>"), {"value": "Ann"})
+
+        self.assertEqual("Ann", res)
+
+    def test_parse_without_match_returns_empty_string(self):
+        self.assertEqual("", TagParser("name").parse(Text("nothing")))
+
+
+if __name__ == "__main__":
+    unittest.main()
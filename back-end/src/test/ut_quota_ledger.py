@@ -0,0 +1,126 @@
+import sys
+import unittest
+from unittest import mock
+
+import fakeredis
+
+sys.path.append("../")
+
+import services.quota_ledger as quota_ledger
+from services.quota_ledger import DIRTY_USER_SET_NAME, QuotaLedger
+
+SCRIPT_NAMES = ("_CONSUME_SCRIPT", "_LOAD_SCRIPT", "_TAKE_PENDING_SCRIPT", "_RELEASE_SCRIPT")
+
+
+class TestQuotaLedger(unittest.TestCase):
+    """Quota ledger on fakeredis, which runs the Lua scripts, with t_user_quota in a dict."""
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        # user id -> [quota_available, quota_used]
+        self.db_quota = {"u1": [10, 5]}
+        self.fail_db_update = False
+
+        patch_list = [
+            mock.patch.object(quota_ledger, "r", self.redis),
+            mock.patch.object(quota_ledger, "db"),
+            mock.patch.object(QuotaLedger, "_load", side_effect=self._load),
+        ]
+        for name in SCRIPT_NAMES:
+            script = self.redis.register_script(getattr(quota_ledger, name).script)
+            patch_list.append(mock.patch.object(quota_ledger, name, script))
+        for patch in patch_list:
+            patch.start()
+            self.addCleanup(patch.stop)
+        quota_ledger.db.session.execute.side_effect = self._execute_update
+
+    def _load(self, user_id):
+        available, used = self.db_quota[user_id]
+        quota_ledger._LOAD_SCRIPT(keys=[self._name(user_id)], args=[available, used, 300])
+
+    def _execute_update(self, statement):
+        if self.fail_db_update:
+            raise RuntimeError("db down")
+        params = statement.compile().params
+        quota = self.db_quota[params["user_id_1"]]
+        quota[0] -= params["quota_available_1"]
+        quota[1] += params["quota_used_1"]
+
+    @staticmethod
+    def _name(user_id):
+        return f"quota-ledger:{user_id}"
+
+    def test_get_loads_quota(self):
+        self.assertEqual({"quota_available": 10, "quota_used": 5}, QuotaLedger.get("u1"))
+        self.assertGreater(self.redis.ttl(self._name("u1")), 0)
+
+    def test_consume(self):
+        self.assertEqual(6, QuotaLedger.consume("u1", 4))
+        self.assertEqual({"quota_available": 6, "quota_used": 9}, QuotaLedger.get("u1"))
+        self.assertEqual(-1, self.redis.ttl(self._name("u1")))
+        self.assertEqual({b"u1"}, self.redis.smembers(DIRTY_USER_SET_NAME))
+
+    def test_consume_insufficient(self):
+        self.assertIsNone(QuotaLedger.consume("u1", 11))
+        self.assertEqual({"quota_available": 10, "quota_used": 5}, QuotaLedger.get("u1"))
+        self.assertEqual(set(), self.redis.smembers(DIRTY_USER_SET_NAME))
+
+    def test_consume_nothing_leaves_entry_idle(self):
+        self.assertEqual(10, QuotaLedger.consume("u1", 0))
+        self.assertGreater(self.redis.ttl(self._name("u1")), 0)
+        self.assertEqual(set(), self.redis.smembers(DIRTY_USER_SET_NAME))
+
+    def test_reserve_and_settle(self):
+        self.assertTrue(QuotaLedger.reserve("t1", "u1", 6, 2))
+        self.assertEqual(4, QuotaLedger.get("u1")["quota_available"])
+
+        # One of three units completed, the other two are refunded, and only once
+        self.assertEqual(4, QuotaLedger.settle("t1", 1))
+        self.assertEqual(0, QuotaLedger.settle("t1", 1))
+        self.assertEqual({"quota_available": 8, "quota_used": 7}, QuotaLedger.get("u1"))
+
+    def test_reserve_insufficient(self):
+        self.assertFalse(QuotaLedger.reserve("t1", "u1", 11, 1))
+        self.assertEqual(0, QuotaLedger.settle("t1", 0))
+        self.assertEqual(10, QuotaLedger.get("u1")["quota_available"])
+
+    def test_reserve_nothing(self):
+        self.assertTrue(QuotaLedger.reserve("t1", "u1", 0, 0))
+        self.assertEqual(0, QuotaLedger.settle("t1", 0))
+
+    def test_flush_applies_pending_and_releases_entry(self):
+        QuotaLedger.consume("u1", 3)
+        QuotaLedger.consume("u1", 2)
+
+        self.assertEqual(1, QuotaLedger.flush())
+        self.assertEqual([5, 10], self.db_quota["u1"])
+        self.assertFalse(self.redis.exists(self._name("u1")))
+        self.assertEqual(set(), self.redis.smembers(DIRTY_USER_SET_NAME))
+
+        # The next use reloads from the DB, picking up changes made there
+        self.db_quota["u1"][0] += 100
+        self.assertEqual(105, QuotaLedger.get("u1")["quota_available"])
+
+    def test_flush_releases_netted_out_entry(self):
+        QuotaLedger.reserve("t1", "u1", 4, 1)
+        QuotaLedger.settle("t1", 0)
+
+        self.assertEqual(0, QuotaLedger.flush())
+        self.assertEqual([10, 5], self.db_quota["u1"])
+        self.assertFalse(self.redis.exists(self._name("u1")))
+
+    def test_flush_failure_keeps_pending(self):
+        QuotaLedger.consume("u1", 3)
+        self.fail_db_update = True
+
+        self.assertEqual(0, QuotaLedger.flush())
+        self.assertEqual(b"3", self.redis.hget(self._name("u1"), "pending"))
+        self.assertEqual({b"u1"}, self.redis.smembers(DIRTY_USER_SET_NAME))
+
+        self.fail_db_update = False
+        self.assertEqual(1, QuotaLedger.flush())
+        self.assertEqual([7, 8], self.db_quota["u1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import sys
+import unittest
+from unittest import mock
+
+import openai
+import requests
+
+sys.path.append("../")
+
+import core.retry as retry
+from core.retry import backoff_delay, call_with_retry, is_transient_error
+
+
+class FlakyCall:
+    """Callable raising the given errors in turn, then returning "ok"."""
+
+    def __init__(self, *error_list):
+        self.error_list = list(error_list)
+        self.call_count = 0
+
+    def __call__(self):
+        self.call_count += 1
+        if self.error_list:
+            raise self.error_list.pop(0)
+        return "ok"
+
+
+class TestIsTransientError(unittest.TestCase):
+    def test_transient_errors(self):
+        for e in (openai.error.RateLimitError("slow down"),
+                  openai.error.Timeout("timeout"),
+                  openai.error.ServiceUnavailableError("unavailable"),
+                  openai.error.APIConnectionError("reset"),
+                  requests.exceptions.ConnectionError(),
+                  requests.exceptions.Timeout(),
+                  ConnectionResetError(),
+                  TimeoutError()):
+            self.assertTrue(is_transient_error(e), e)
+
+    def test_api_error_by_status(self):
+        self.assertTrue(is_transient_error(openai.error.APIError("bad gateway", http_status=502)))
+        self.assertTrue(is_transient_error(openai.error.APIError("no status")))
+        self.assertFalse(is_transient_error(openai.error.APIError("bad request", http_status=400)))
+
+    def test_permanent_errors(self):
+        for e in (openai.error.InvalidRequestError("bad prompt", param=None),
+                  openai.error.AuthenticationError("bad key"),
+                  ValueError("bad row"),
+                  KeyError("name")):
+            self.assertFalse(is_transient_error(e), e)
+
+
+class TestCallWithRetry(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(retry.time, "sleep")
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_success_is_not_retried(self):
+        func = FlakyCall()
+
+        self.assertEqual("ok", call_with_retry(func))
+        self.assertEqual(1, func.call_count)
+        self.sleep.assert_not_called()
+
+    def test_transient_errors_are_retried(self):
+        func = FlakyCall(TimeoutError(), openai.error.RateLimitError("slow down"))
+
+        self.assertEqual("ok", call_with_retry(func, max_retries=3))
+        self.assertEqual(3, func.call_count)
+        self.assertEqual(2, self.sleep.call_count)
+
+    def test_permanent_error_is_raised_right_away(self):
+        func = FlakyCall(ValueError("bad row"))
+
+        with self.assertRaises(ValueError):
+            call_with_retry(func, max_retries=3)
+        self.assertEqual(1, func.call_count)
+        self.sleep.assert_not_called()
+
+    def test_gives_up_after_max_retries(self):
+        func = FlakyCall(*[TimeoutError() for _ in range(5)])
+
+        with self.assertRaises(TimeoutError):
+            call_with_retry(func, max_retries=2)
+        self.assertEqual(3, func.call_count)
+
+    def test_backoff_grows_up_to_max_delay(self):
+        func = FlakyCall(*[TimeoutError() for _ in range(4)])
+
+        call_with_retry(func, max_retries=4, base_delay=2, max_delay=5)
+
+        delay_list = [call.args[0] for call in self.sleep.call_args_list]
+        for delay, upper in zip(delay_list, (2, 4, 5, 5)):
+            self.assertLessEqual(upper / 2, delay)
+            self.assertLessEqual(delay, upper)
+
+    def test_backoff_delay_is_jittered_within_bounds(self):
+        for attempt in range(6):
+            delay = backoff_delay(attempt, 1, 10)
+            upper = min(10, 2 ** attempt)
+            self.assertTrue(upper / 2 <= delay <= upper)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import sys
+import unittest
+
+sys.path.append("../")
+
+from core.component.utils import CompiledTemplate, compile_template
+
+
+class TestCompiledTemplate(unittest.TestCase):
+    def test_render_replaces_known_variables(self):
+        template = CompiledTemplate("ad{a}s{d}")
+
+        self.assertEqual("ad11s{d}", template.render({"a": "11", "c": "22"}))
+
+    def test_render_without_variables_returns_template(self):
+        template = CompiledTemplate("Hello {name}")
+
+        self.assertEqual("Hello {name}", template.render())
+        self.assertEqual("Hello {name}", template.render({}))
+
+    def test_render_repeated_and_adjacent_placeholders(self):
+        template = CompiledTemplate("{a}{b}-{a}")
+
+        self.assertEqual("12-1", template.render({"a": 1, "b": 2}))
+
+    def test_render_is_single_pass(self):
+        # A value containing a placeholder is not substituted again
+        template = CompiledTemplate("{a} {b}")
+
+        self.assertEqual("{b} 2", template.render({"a": "{b}", "b": "2"}))
+
+    def test_variables(self):
+        template = CompiledTemplate("{x} and {y}, then {x}")
+
+        self.assertEqual(frozenset({"x", "y"}), template.variables)
+
+    def test_literal_text_is_kept(self):
+        template = CompiledTemplate("no placeholders here")
+
+        self.assertEqual("no placeholders here", template.render({"a": "1"}))
+        self.assertEqual(frozenset(), template.variables)
+
+    def test_compile_template_is_cached(self):
+        self.assertIs(compile_template("cached {a}"), compile_template("cached {a}"))
+
+
+if __name__ == "__main__":
+    unittest.main()
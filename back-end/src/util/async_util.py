@@ -0,0 +1,17 @@
+"""Async util."""
+import asyncio
+
+
+def iterate_async(async_iterable):
+    """Iterate an async iterable from synchronous code on a private event loop."""
+    loop = asyncio.new_event_loop()
+    iterator = async_iterable.__aiter__()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
@@ -0,0 +1,52 @@
+"""Server-Sent Events util."""
+import json
+
+from flask import Response, current_app
+
+from connection import db
+
+
+def sse(event, data):
+    """Format a Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_comment(text=""):
+    """Format a Server-Sent Events comment, used to keep idle connections open."""
+    return f": {text}\n\n"
+
+
+def sse_response(events):
+    """Stream events as a Server-Sent-Events response.
+
+    Streams can stay open for a long time, so the request's DB session is closed here and
+    events must be a plain generator that does not need the app context.
+    """
+    db.session.close()
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def sse_task_events(records, include_results=True):
+    """Format the events of a task as Server-Sent Events, sending comments as heartbeats."""
+    heartbeat_sec = current_app.config.get("TASK_EVENT_HEARTBEAT_SEC", 15)
+    max_duration_sec = current_app.config.get("TASK_EVENT_STREAM_MAX_SEC", 3600)
+
+    def generate():
+        for event, data in records.iter_events(include_results=include_results,
+                                               heartbeat_sec=heartbeat_sec,
+                                               max_duration_sec=max_duration_sec):
+            if event is None:
+                yield sse_comment("heartbeat")
+            else:
+                yield sse(event, data)
+
+    return generate()
+
+
+def sse_finished_task(status, progress):
+    """Format the final state of a task that has already finished."""
+    yield sse("progress", progress)
+    yield sse("end", {"status": status})
@@ -93,6 +93,16 @@ create index idx_task_appid on t_task (app_id);
 create index idx_task_fileid on t_task (file_id);
 create index idx_task_userid on t_task (created_by);
 
+create table t_task_result
+(
+    id          INT AUTO_INCREMENT primary key,
+    task_id     varchar(36)  not null comment 'task id',
+    row_index   INT          not null comment 'index of the row in the task file',
+    result      JSON,
+    CONSTRAINT fk_task_result_task FOREIGN KEY (task_id) REFERENCES t_task (id),
+    CONSTRAINT uq_task_result_row UNIQUE (task_id, row_index)
+);
+
 CREATE TABLE t_embedding (
     id VARCHAR(36) primary key,
     embedding_name VARCHAR(200) NOT NULL COMMENT 'embedding name',